@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+#
+# The MIT License
+#
+# Copyright (c) 2009 Josh Wright
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# ***** END LICENSE BLOCK *****
+
+"""Measure the memory used by each live xpcom.client wrapper.
+
+Usage: python benchmark_wrappers.py [path to VBoxPython.so] [wrappers per machine]
+
+Wraps every registered machine many times over and reports the bytes
+held by each wrapper itself - everything reachable from it that is not
+shared through the xpcom.client module or the underlying XPCOM object.
+The wrappers are built directly, bypassing the MakeInterfaceResult cache
+that would otherwise hand back one wrapper per machine.
+"""
+
+import sys, gc
+
+def _reachable(roots, stop):
+    seen = {}
+    pending = list(roots)
+    while pending:
+        ob = pending.pop()
+        if id(ob) in seen or id(ob) in stop or isinstance(ob, (type, type(sys))):
+            continue
+        seen[id(ob)] = ob
+        pending.extend(gc.get_referents(ob))
+    return seen
+
+def bytes_per_wrapper(wrappers, raw_objects):
+    import xpcom.client
+    shared = _reachable([xpcom.client.__dict__] + list(raw_objects), {})
+    own = _reachable(wrappers, shared)
+    return sum([sys.getsizeof(ob) for ob in own.values()]) / float(len(wrappers))
+
+def main(argv):
+    vbox_path = '/usr/lib/virtualbox'
+    count = 1000
+    if len(argv) > 1:
+        vbox_path = argv[1]
+    if len(argv) > 2:
+        count = int(argv[2])
+    sys.path.append(vbox_path)
+    import xpcom.vboxxpcom
+    import xpcom.client
+    import xpcom.components
+    vbox = xpcom.components.classes["@virtualbox.org/VirtualBox;1"].createInstance()
+    iid = xpcom.components.interfaces.IMachine
+    machines = [vm._comobj_ for vm in vbox.getMachines()]
+    if not machines:
+        print "No machines are registered"
+        return
+    wrappers = []
+    for raw in machines:
+        for i in range(count):
+            wrapper = xpcom.client.Component(raw, iid)
+            wrapper.name
+            wrappers.append(wrapper)
+    print "%d wrappers: %.0f bytes each" % (len(wrappers), bytes_per_wrapper(wrappers, machines))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+#
+# The MIT License
+#
+# Copyright (c) 2009 Josh Wright
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# ***** END LICENSE BLOCK *****
+
+"""Ahead-of-time Python bindings for the VirtualBox interfaces.
+
+xpcom.client normally builds the code for an interface the first time a
+process uses it. write_bindings() does the same work once for every
+VirtualBox interface and saves it as an ordinary module, and
+load_bindings() fills the xpcom.client caches from that module at
+startup. Interfaces missing from the module are still built on demand.
+"""
+
+import os, glob, hashlib, time
+import xpcom._xpcom, xpcom.client
+from xpcom import xpt, COMException, logger
+
+MODULE_HEADER = '''# Generated by "vboxweb.py --build-bindings" on %s - do not edit.
+from xpcom._xpcom import XPTC_InvokeByIndex
+
+STAMP = %r
+'''
+
+def typelib_stamp(vbox_path, version):
+    """The VirtualBox version and an MD5 digest of the XPCOM typelibs it
+    installed, or None if there are no typelibs under vbox_path."""
+    filenames = sorted(glob.glob(os.path.join(vbox_path, 'components', '*.xpt')))
+    if not filenames:
+        return None
+    digest = hashlib.md5()
+    for filename in filenames:
+        f = open(filename, 'rb')
+        digest.update(os.path.basename(filename))
+        digest.update(f.read())
+        f.close()
+    return '%s/%s' % (version, digest.hexdigest())
+
+def vbox_interface_names():
+    import xpcom.components
+    return sorted([name for name in xpcom.components.interfaces.keys()
+                   if name.startswith('I') and not name.startswith('IID')])
+
+def _interface_source(name):
+    interface = xpt.Interface(name)
+    method_infos, getters, setters, constants = xpcom.client._BuildInterfaceInfo(interface.GetIID())
+    lines = ['', 'class %s:' % (name,),
+             '    _iid_ = %r' % (str(interface.GetIID()),),
+             '    _getters_ = %r' % (getters,),
+             '    _setters_ = %r' % (setters,),
+             '    _constants_ = %r' % (constants,),
+             '    _methods_ = %r' % (sorted(method_infos.keys()),)]
+    for method_name in sorted(method_infos.keys()):
+        code = xpcom.client._MakeMethodCode(method_infos[method_name])
+        lines.extend(['    ' + line for line in code.strip().splitlines()])
+    return '\n'.join(lines) + '\n'
+
+def write_bindings(filename, vbox_path, version):
+    """Write the bindings for every VirtualBox interface to filename.
+
+    Interfaces that can't be described (usually because they are not
+    scriptable) are logged and left out; they are still built on demand.
+    Returns (the names written, the names skipped)."""
+    stamp = typelib_stamp(vbox_path, version)
+    if stamp is None:
+        raise ValueError, "No XPCOM typelibs found in %s" % (os.path.join(vbox_path, 'components'),)
+    written = []
+    skipped = []
+    tmp_filename = filename + '.tmp'
+    f = open(tmp_filename, 'w')
+    try:
+        try:
+            f.write(MODULE_HEADER % (time.strftime('%Y-%m-%d %H:%M:%S'), stamp))
+            for name in vbox_interface_names():
+                try:
+                    source = _interface_source(name)
+                except COMException, why:
+                    logger.warning("Failed to build interface info for %s: %s", name, why)
+                    skipped.append(name)
+                    continue
+                f.write(source)
+                written.append(name)
+            f.write('\nINTERFACES = (%s)\n' % (''.join(['%s, ' % (name,) for name in written]),))
+        finally:
+            f.close()
+    except:
+        os.remove(tmp_filename)
+        raise
+    os.rename(tmp_filename, filename)
+    return written, skipped
+
+class PrebuiltMethodInfo:
+    """Stands in for the xpt.Method of a method whose code came from a
+    bindings module, which is all xpcom.client.BuildMethod looks at once
+    the method is cached."""
+
+    def __init__(self, name):
+        self.name = name
+
+def load_bindings(module, vbox_path, version):
+    """Fill the xpcom.client caches from a module written by write_bindings().
+
+    Returns the number of interfaces loaded, or None if the module was
+    built for a different VirtualBox or the typelibs can't be found."""
+    stamp = typelib_stamp(vbox_path, version)
+    if stamp is None or getattr(module, 'STAMP', None) != stamp:
+        return None
+    loaded = 0
+    for interface in module.INTERFACES:
+        iid = xpcom._xpcom.IID(interface._iid_)
+        methods = {}
+        method_infos = {}
+        for name in interface._methods_:
+            methods[name] = interface.__dict__[name]
+            method_infos[name] = PrebuiltMethodInfo(name)
+        info = method_infos, interface._getters_, interface._setters_, interface._constants_
+        if xpcom.client.RegisterInterfaceInfo(iid, info, methods):
+            loaded += 1
+    return loaded
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+#
+# The MIT License
+#
+# Copyright (c) 2009 Josh Wright
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# ***** END LICENSE BLOCK *****
+
+import threading, time
+
+class GuestOSRecord:
+    """Plain Python copy of an IGuestOSType."""
+
+    def __init__(self, id, description, familyId, is64Bit):
+        self.id = id
+        self.description = description
+        self.familyId = familyId
+        self.is64Bit = is64Bit
+
+    def __repr__(self):
+        return '<GuestOSRecord %s>' % (self.id,)
+
+def read_guest_os_type(os_type):
+    # familyId and is64Bit are missing from some VirtualBox builds.
+    try:
+        family = os_type.familyId
+    except AttributeError:
+        family = None
+    try:
+        is_64_bit = bool(os_type.is64Bit)
+    except AttributeError:
+        is_64_bit = os_type.id.endswith('_64')
+    return GuestOSRecord(os_type.id, os_type.description, family, is_64_bit)
+
+class GuestOSCatalog:
+    """The guest OS types VirtualBox supports, read once per VirtualBox version.
+
+    The list is fixed for an installation, so it is only read again if
+    vbox.version changes, i.e. VBoxSVC was upgraded underneath us. The
+    version itself is checked at most every check_interval seconds, so
+    lookups in between are plain dict reads with no XPCOM calls.
+    """
+
+    def __init__(self, vbox, check_interval=60):
+        self.vbox = vbox
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.version = None
+        self.checked_at = None
+        # (records keyed by OS type id, records in getGuestOSTypes() order),
+        # replaced as a pair so lock-free readers never see a mix.
+        self.loaded = ({}, [])
+
+    def _load(self):
+        checked_at = self.checked_at
+        if checked_at is not None and time.time() - checked_at < self.check_interval:
+            return self.loaded
+        self.lock.acquire()
+        try:
+            if self.checked_at is not checked_at:
+                # Another thread checked while we waited.
+                return self.loaded
+            version = self.vbox.version
+            if version != self.version:
+                order = [read_guest_os_type(os_type) for os_type in self.vbox.getGuestOSTypes()]
+                self.loaded = dict([(record.id, record) for record in order]), order
+                self.version = version
+            self.checked_at = time.time()
+            return self.loaded
+        finally:
+            self.lock.release()
+
+    def all(self):
+        return list(self._load()[1])
+
+    def get(self, os_type_id):
+        return self._load()[0].get(os_type_id)
+
+    def description(self, os_type_id):
+        """Describe os_type_id, falling back to the id for unknown types."""
+        record = self.get(os_type_id)
+        if record is None:
+            return os_type_id
+        return record.description
@@ -25,33 +25,115 @@
 #
 # ***** END LICENSE BLOCK *****
 
-import os, sys, traceback, cherrypy, pickle
-from genshi.template import TemplateLoader
+import os, sys, traceback, threading, cherrypy, pickle, simplejson
+import xpcom
 from genshi.filters import HTMLFormFiller
-
-loader = TemplateLoader(
-    os.path.join(os.path.dirname(__file__), 'templates'),
-    auto_reload=True
-)
+from templating import render, render_stats, options, fragments
+from inventory import snapshot_machine
+from jobs import drain_host
+from executor import executor_stats
 
 VM_STATES = (None, 'Powered Off', 'Saved', 'Aborted', 'Running', 'Paused',
                 'Stuck', 'Starting', 'Stopping', 'Saving', 'Restoring',
                 'Discarding', 'Setting Up')
 
+def positive_int(value, name):
+    """Parse a request parameter that must be a whole number of at least 1."""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        value = 0
+    if value < 1:
+        raise cherrypy.HTTPError(400, "%s must be a whole number of at least 1" % (name,))
+    return value
+
+def memory_errors(props, form_data):
+    """Check the memory and vram form fields against the VirtualBox limits."""
+    errors = []
+    for field, label, low, high in (('memory', 'Memory', props.minGuestRAM, props.maxGuestRAM),
+                                    ('vram', 'Video memory', props.minGuestVRAM, props.maxGuestVRAM)):
+        try:
+            size = int(form_data[field])
+        except (KeyError, ValueError):
+            errors.append("%s must be a number of megabytes." % (label,))
+            continue
+        if not low <= size <= high:
+            errors.append("%s must be between %dMB and %dMB." % (label, low, high))
+    return errors
+
+def check_etag(etag):
+    """Send etag with the response, answering 304 if the client already has it.
+
+    Call this before doing any real work for the page.
+    """
+    cherrypy.response.headers['ETag'] = etag
+    if cherrypy.request.method.upper() not in ('GET', 'HEAD'):
+        return
+    if_none_match = cherrypy.request.headers.get('If-None-Match')
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        if etag in tags or '*' in tags:
+            raise cherrypy.HTTPRedirect([], 304)
+
 class Root:
 
-    def __init__(self, mgr, vbox):
+    def __init__(self, mgr, vbox, inventory, catalog, generations, event_stream, event_loop, poller):
         self.mgr = mgr
         self.vbox = vbox
+        self.inventory = inventory
+        self.catalog = catalog
+        self.generations = generations
+        self.event_stream = event_stream
+        self.event_loop = event_loop
+        self.poller = poller # None unless machine states are polled
 
     @cherrypy.expose
     def index(self):
+        check_etag(self.generations.etag('inventory', self.generations.inventory))
         if float(self.vbox.version[:3]) < 2.2:
             error_message = "VBoxWeb only supports VirtualBox version 2.2 and higher, you are running VirtualBox %s" % (self.vbox.version,)
-            tmpl = loader.load('error.html')
-            return tmpl.generate(error_message=error_message).render('html', doctype='html')
-        tmpl = loader.load('index.html')
-        return tmpl.generate(vms=self.vbox.getMachines(), VM_STATES=VM_STATES).render('html', doctype='html')
+            return render('error.html', error_message=error_message)
+        return render('index.html', vms=self.inventory.machines(), VM_STATES=VM_STATES, guest_os_description=self.catalog.description)
+
+    @cherrypy.expose
+    def machine(self, uuid):
+        vm = self.inventory.get(uuid)
+        if vm is None:
+            raise cherrypy.NotFound()
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return simplejson.dumps({'id': vm.id, 'name': vm.name, 'OSTypeId': vm.OSTypeId,
+                                 'os': self.catalog.description(vm.OSTypeId),
+                                 'state': vm.state, 'state_name': VM_STATES[vm.state]})
+
+    @cherrypy.expose
+    def events(self, last_id=None):
+        if cherrypy.request.method.upper() != 'GET':
+            cherrypy.response.headers['Allow'] = 'GET'
+            raise cherrypy.HTTPError(405)
+        # The browser sends Last-Event-ID when it reconnects by itself, and
+        # vboxweb.js passes last_id when it retries after a 503.
+        last_id = cherrypy.request.headers.get('Last-Event-ID', last_id)
+        if not self.event_stream.admit():
+            cherrypy.response.headers['Retry-After'] = '30'
+            raise cherrypy.HTTPError(503, "Too many event listeners")
+        # Runs however the request ends, even if the body is never started.
+        cherrypy.request.hooks.attach('on_end_request', self.event_stream.release)
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        return self.event_stream.listen(last_id)
+    events._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def stats(self):
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        poller_stats = None
+        if self.poller is not None:
+            poller_stats = self.poller.stats()
+        return simplejson.dumps({'templates': render_stats(), 'events': self.event_loop.stats(),
+                                 'poller': poller_stats,
+                                 'event_stream': self.event_stream.stats(),
+                                 'xpcom_executor': executor_stats(),
+                                 'xpcom_wrappers': xpcom.client.WrapperCacheStats()})
 
     @cherrypy.expose
     def config(self, **form_data):
@@ -62,8 +144,7 @@ class Root:
             if form_data['password']:
                 if form_data['password'] != form_data['password_confirm']:
                     error_message = "Passwords don't match"
-                    tmpl = loader.load('error.html')
-                    return tmpl.generate(error_message=error_message).render('html', doctype='html')
+                    return render('error.html', error_message=error_message)
                 vboxweb_config['password'] = form_data['password']
             vboxweb_config['username'] = form_data['username']
             vboxweb_config['port'] = int(form_data['port'])
@@ -75,93 +156,163 @@ class Root:
             form_data = {'username': vboxweb_config['username'],
                          'port': vboxweb_config['port'],
                         }
-            tmpl = loader.load('config.html')
             filler = HTMLFormFiller(data=form_data)
-            return tmpl.generate().filter(filler).render('html', doctype='html')
+            return render('config.html', filler)
 
 class VM:
 
-    def __init__(self, mgr, vbox):
+    def __init__(self, mgr, vbox, jobs, boot_scheduler, catalog, system_properties, generations, bus):
         self.mgr = mgr
         self.vbox = vbox
+        self.jobs = jobs
+        self.boot_scheduler = boot_scheduler
+        self.catalog = catalog
+        self.system_properties = system_properties
+        self.generations = generations
+        self.bus = bus
+        # XPCOM calls made building vm/info.html snapshots, for /vm/stats.
+        self.info_lock = threading.Lock()
+        self.info_renders = 0
+        self.info_xpcom_calls = 0
+        self.info_last_xpcom_calls = None
 
     @cherrypy.expose
     def info(self, uuid):
-        vm = self.vbox.getMachine(uuid)
-        state = VM_STATES[int(vm.state)]
-        os_type_obj = self.vbox.getGuestOSType(vm.OSTypeId)
-        guest_os = os_type_obj.description
-        boot_devices = []
-        for position in range(1, self.vbox.systemProperties.maxBootPosition + 1):
-            device = vm.getBootOrder(position)
-            if device != 0:
-                boot_devices.append(device)
-        disk_attachments = vm.getHardDiskAttachments()
-        shared_folders = vm.getSharedFolders()
-        tmpl = loader.load('vm/info.html')
-        return tmpl.generate(vm=vm, state=state, guest_os=guest_os, disk_attachments=disk_attachments, shared_folders=shared_folders, boot_devices=boot_devices).render('html', doctype='html')
+        # The page also shows details of the attached hard disks.
+        check_etag(self.generations.etag('vm', uuid, self.generations.machine(uuid), self.generations.media))
+        vm = snapshot_machine(self.vbox.getMachine(uuid), self.system_properties.snapshot().maxBootPosition)
+        self.info_lock.acquire()
+        try:
+            self.info_renders += 1
+            self.info_xpcom_calls += vm.xpcom_calls
+            self.info_last_xpcom_calls = vm.xpcom_calls
+        finally:
+            self.info_lock.release()
+        state = VM_STATES[vm.state]
+        guest_os = self.catalog.description(vm.OSTypeId)
+        return render('vm/info.html', vm=vm, state=state, guest_os=guest_os, disk_attachments=vm.hardDiskAttachments, shared_folders=vm.sharedFolders, boot_devices=vm.bootOrder)
 
     @cherrypy.expose
     def control(self, action, uuid):
-        if action == 'power_up':
-            session = self.mgr.getSessionObject(self.vbox)
-            progress = self.vbox.openRemoteSession(session, uuid, 'vrdp', '')
-            progress.waitForCompletion(-1)
-        else:
-            session = self.mgr.getSessionObject(self.vbox)
-            self.vbox.openExistingSession(session, uuid)
-            console = session.console
-            if action == 'power_off':
-                console.powerDown()
-            elif action == 'reset':
-                console.reset()
-            elif action == 'pause':
-                console.pause()
-            elif action == 'save_state':
-                progress = console.saveState()
-                progress.waitForCompletion(-1)
-            elif action == 'resume':
-                console.resume()
-        session.close()
+        try:
+            job = self.jobs.submit(action, uuid)
+        except ValueError, e:
+            raise cherrypy.HTTPError(400, str(e))
+        if cherrypy.request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            cherrypy.response.headers['Content-Type'] = 'application/json'
+            return simplejson.dumps(job.status_dict())
         raise cherrypy.HTTPRedirect('/vm/info/' + uuid)
 
+    @cherrypy.expose
+    def bulk_control(self, action, uuids):
+        if cherrypy.request.method.upper() != 'POST':
+            raise cherrypy.HTTPError(405)
+        # A single uuid arrives as a plain string rather than a list.
+        if isinstance(uuids, basestring):
+            uuids = [uuids]
+        try:
+            finished = self.jobs.submit_many(action, uuids)
+        except ValueError, e:
+            raise cherrypy.HTTPError(400, str(e))
+        cherrypy.response.headers['Content-Type'] = 'text/plain'
+        # One JSON document per line, written as each machine finishes.
+        def stream():
+            for job in finished:
+                yield simplejson.dumps(job.status_dict()) + '\n'
+        return stream()
+    bulk_control._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def boot(self, uuids, max_starts=None):
+        if cherrypy.request.method.upper() != 'POST':
+            raise cherrypy.HTTPError(405)
+        if isinstance(uuids, basestring):
+            uuids = [uuids]
+        if max_starts is not None:
+            max_starts = positive_int(max_starts, 'max_starts')
+        run = self.boot_scheduler.power_up(uuids, max_starts)
+        cherrypy.response.headers['Content-Type'] = 'text/plain'
+        def stream():
+            for job in run:
+                yield simplejson.dumps(job.status_dict()) + '\n'
+            yield simplejson.dumps({'count': run.count, 'elapsed': run.elapsed()}) + '\n'
+        return stream()
+    boot._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def drain(self, max_saves=2):
+        if cherrypy.request.method.upper() != 'POST':
+            raise cherrypy.HTTPError(405)
+        run = drain_host(self.vbox, self.jobs, positive_int(max_saves, 'max_saves'))
+        cherrypy.response.headers['Content-Type'] = 'text/plain'
+        def stream():
+            for job in run:
+                yield simplejson.dumps(job.status_dict()) + '\n'
+            yield simplejson.dumps({'count': run.count, 'elapsed': run.elapsed(),
+                                    'saved': run.saved, 'throughput': run.throughput()}) + '\n'
+        return stream()
+    drain._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    def stats(self):
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return simplejson.dumps({'sessions': self.mgr.stats(),
+                                 'progress_pending': self.jobs.reactor.pending(),
+                                 'jobs_queued': self.jobs.queue.qsize(),
+                                 'info': {'renders': self.info_renders,
+                                          'xpcom_calls': self.info_xpcom_calls,
+                                          'last_xpcom_calls': self.info_last_xpcom_calls}})
+
+    @cherrypy.expose
+    def job(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise cherrypy.NotFound()
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return simplejson.dumps(job.status_dict())
+
     @cherrypy.expose
     def modify(self, uuid, **form_data):
         if cherrypy.request.method.upper() == 'POST':
-            #TODO Some form validation might be nice, eh?
+            errors = memory_errors(self.system_properties.snapshot(), form_data)
+            if errors:
+                return render('error.html', error_message=' '.join(errors))
             try:
                 session = self.mgr.getSessionObject(self.vbox)
-                self.vbox.openSession(session, uuid)
-                vm = session.machine
-                vm.name = form_data['name']
-                vm.description = form_data['description']
-                vm.memorySize = form_data['memory']
-                vm.VRAMSize = form_data['vram']
-                vm.BIOSSettings.ACPIEnabled = 0
-                vm.BIOSSettings.IOAPICEnabled = 0
-                vm.HWVirtExEnabled = 0
-                vm.HWVirtExNestedPagingEnabled = 0
-                vm.PAEEnabled = 0
-                vm.accelerate3DEnabled = 0
-                if 'acpi' in form_data:
-                    vm.BIOSSettings.ACPIEnabled = 1
-                if 'ioapic' in form_data:
-                    vm.BIOSSettings.IOAPICEnabled = 1
-                if 'hwvirtex' in form_data:
-                    vm.HWVirtExEnabled = 1
-                if 'nestedpaging' in form_data:
-                    vm.HWVirtExNestedPagingEnabled = 1
-                if 'pae' in form_data:
-                    vm.PAEEnabled = 1
-                if '3daccel' in form_data:
-                    vm.accelerate3DEnabled = 1
-                vm.saveSettings()
-                session.close()
+                try:
+                    self.vbox.openSession(session, uuid)
+                    vm = session.machine
+                    vm.name = form_data['name']
+                    vm.description = form_data['description']
+                    vm.memorySize = form_data['memory']
+                    vm.VRAMSize = form_data['vram']
+                    vm.BIOSSettings.ACPIEnabled = 0
+                    vm.BIOSSettings.IOAPICEnabled = 0
+                    vm.HWVirtExEnabled = 0
+                    vm.HWVirtExNestedPagingEnabled = 0
+                    vm.PAEEnabled = 0
+                    vm.accelerate3DEnabled = 0
+                    if 'acpi' in form_data:
+                        vm.BIOSSettings.ACPIEnabled = 1
+                    if 'ioapic' in form_data:
+                        vm.BIOSSettings.IOAPICEnabled = 1
+                    if 'hwvirtex' in form_data:
+                        vm.HWVirtExEnabled = 1
+                    if 'nestedpaging' in form_data:
+                        vm.HWVirtExNestedPagingEnabled = 1
+                    if 'pae' in form_data:
+                        vm.PAEEnabled = 1
+                    if '3daccel' in form_data:
+                        vm.accelerate3DEnabled = 1
+                    vm.saveSettings()
+                finally:
+                    self.mgr.releaseSessionObject(session)
+                # Only reached once saveSettings() has succeeded.
+                self.bus.publish('onMachineDataChange', uuid)
                 raise cherrypy.HTTPRedirect('/vm/info/' + uuid)
             except xpcom.COMException,e:
                 error_message = "Unable to modify VM. %s" % (e,)
-                tmpl = loader.load('error.html')
-                return tmpl.generate(error_message=error_message).render('html', doctype='html')
+                return render('error.html', error_message=error_message)
         else:
             vm = self.vbox.getMachine(uuid)
             form_data = {'name': vm.name,
@@ -177,49 +328,59 @@ class VM:
             if vm.HWVirtExEnabled == 1:
                 form_data['hwvirtex'] = True
             filler = HTMLFormFiller(data=form_data)
-            tmpl = loader.load('vm/modify.html')
-            return tmpl.generate(vm=vm).filter(filler).render('html', doctype='html')
+            return render('vm/modify.html', filler, vm=vm)
 
     @cherrypy.expose
     def create(self, **form_data):
         if cherrypy.request.method.upper() == 'POST':
-            #TODO Some form validation might be nice, eh?
+            errors = memory_errors(self.system_properties.snapshot(), form_data)
+            if errors:
+                return render('error.html', error_message=' '.join(errors))
             new_vm = self.vbox.createMachine(form_data['name'], form_data['guest_os'], '', '00000000-0000-0000-0000-000000000000')
             new_vm.description = form_data['description']
             new_vm.memorySize = form_data['memory']
             new_vm.VRAMSize = form_data['vram']
             new_vm.saveSettings()
             self.vbox.registerMachine(new_vm)
+            self.bus.publish('onMachineRegistered', new_vm.id, True)
             raise cherrypy.HTTPRedirect('/')
         else:
-            base_memory_range = range(4, 3585)
-            video_memory_range = range(1, 129)
-            tmpl = loader.load('vm/create.html')
-            return tmpl.generate(guest_oses=self.vbox.getGuestOSTypes(), base_memory_range=base_memory_range, video_memory_range=video_memory_range).render('html', doctype='html')
+            version = self.vbox.version
+            props = self.system_properties.snapshot()
+            min_ram, max_ram = props.minGuestRAM, props.maxGuestRAM
+            min_vram, max_vram = props.minGuestVRAM, props.maxGuestVRAM
+            guest_os_options = fragments.get(('guest_os', version),
+                lambda: options([(os_type.id, os_type.description) for os_type in self.catalog.all()]))
+            base_memory_options = fragments.get(('base_memory', version, min_ram, max_ram),
+                lambda: options([(size, size) for size in range(min_ram, max_ram + 1)]))
+            video_memory_options = fragments.get(('video_memory', version, min_vram, max_vram),
+                lambda: options([(size, size) for size in range(min_vram, max_vram + 1)]))
+            return render('vm/create.html', guest_os_options=guest_os_options, base_memory_options=base_memory_options, video_memory_options=video_memory_options)
 
 class HardDisk:
 
-    def __init__(self, mgr, vbox):
+    def __init__(self, mgr, vbox, system_properties, generations):
         self.mgr = mgr
         self.vbox = vbox
+        self.system_properties = system_properties
+        self.generations = generations
 
     @cherrypy.expose
     def info(self, uuid):
         hard_disk = self.vbox.getHardDisk(uuid)
-        tmpl = loader.load('harddisk/info.html')
-        return tmpl.generate(hard_disk=hard_disk).render('html', doctype='html')
+        return render('harddisk/info.html', hard_disk=hard_disk)
 
     @cherrypy.expose
     def clone(self, uuid):
         source_disk = self.vbox.getHardDisk(uuid)
         if cherrypy.request.method.upper() == 'POST':
-            new_disk = self.vbox.createHardDisk(self.vbox.systemProperties.defaultHardDiskFormat,
-                                                self.vbox.systemProperties.defaultHardDiskFolder)
-        tmpl = loader.load('harddisk/clone.html')
-        return tmpl.generate(source_disk=source_disk).render('html', doctype='html')
+            props = self.system_properties.snapshot()
+            new_disk = self.vbox.createHardDisk(props.defaultHardDiskFormat,
+                                                props.defaultHardDiskFolder)
+        return render('harddisk/clone.html', source_disk=source_disk)
 
     @cherrypy.expose
     def list(self):
+        check_etag(self.generations.etag('media', self.generations.media))
         hard_disks=self.vbox.getHardDisks()
-        tmpl = loader.load('harddisk/list.html')
-        return tmpl.generate(hard_disks=hard_disks).render('html', doctype='html')
+        return render('harddisk/list.html', hard_disks=hard_disks)
@@ -0,0 +1,500 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+#
+# The MIT License
+#
+# Copyright (c) 2009 Josh Wright
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# ***** END LICENSE BLOCK *****
+
+import threading, time, logging, simplejson, Queue
+
+logger = logging.getLogger('vboxweb')
+
+# Topics published on the EventBus; each is named after the
+# IVirtualBoxCallback method it comes from and carries the same arguments.
+TOPICS = ('onMachineStateChange', 'onMachineDataChange', 'onExtraDataChange',
+          'onMediaRegistered', 'onMachineRegistered', 'onSessionStateChange',
+          'onSnapshotTaken', 'onSnapshotDiscarded', 'onSnapshotChange',
+          'onGuestPropertyChange')
+
+class EventBus:
+    """In-process publish/subscribe for VirtualBox events.
+
+    Handlers are called synchronously on the publishing thread, in
+    subscription order. The subscriber lists are replaced rather than
+    changed in place, so publish() never has to take the lock.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = {} # tuple of handlers keyed by topic
+
+    def subscribe(self, topic, handler):
+        if topic not in TOPICS:
+            raise ValueError, "Unknown event topic '%s'" % (topic,)
+        self.lock.acquire()
+        try:
+            self.subscribers[topic] = self.subscribers.get(topic, ()) + (handler,)
+        finally:
+            self.lock.release()
+
+    def unsubscribe(self, topic, handler):
+        self.lock.acquire()
+        try:
+            handlers = list(self.subscribers.get(topic, ()))
+            if handler in handlers:
+                handlers.remove(handler)
+            self.subscribers[topic] = tuple(handlers)
+        finally:
+            self.lock.release()
+
+    def subscribe_listener(self, listener):
+        """Subscribe each method of listener that is named after a topic."""
+        for topic in TOPICS:
+            handler = getattr(listener, topic, None)
+            if handler is not None:
+                self.subscribe(topic, handler)
+
+    def publish(self, topic, *args):
+        for handler in self.subscribers.get(topic, ()):
+            # A failing subscriber must not stop the others, nor travel
+            # back into VBoxSVC when we are called from a callback.
+            try:
+                handler(*args)
+            except Exception:
+                logger.exception("%s handler %r failed", topic, handler)
+
+class VirtualBoxCallback:
+    """IVirtualBoxCallback implementation that publishes every notification
+    on an EventBus."""
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def onMachineStateChange(self, machineId, state):
+        self.bus.publish('onMachineStateChange', machineId, state)
+
+    def onMachineDataChange(self, machineId):
+        self.bus.publish('onMachineDataChange', machineId)
+
+    def onExtraDataCanChange(self, machineId, key, value):
+        # We never veto extra data changes.
+        return True, ''
+
+    def onExtraDataChange(self, machineId, key, value):
+        self.bus.publish('onExtraDataChange', machineId, key, value)
+
+    def onMediaRegistered(self, mediaId, mediaType, registered):
+        self.bus.publish('onMediaRegistered', mediaId, mediaType, registered)
+
+    def onMachineRegistered(self, machineId, registered):
+        self.bus.publish('onMachineRegistered', machineId, registered)
+
+    def onSessionStateChange(self, machineId, state):
+        self.bus.publish('onSessionStateChange', machineId, state)
+
+    def onSnapshotTaken(self, machineId, snapshotId):
+        self.bus.publish('onSnapshotTaken', machineId, snapshotId)
+
+    def onSnapshotDiscarded(self, machineId, snapshotId):
+        self.bus.publish('onSnapshotDiscarded', machineId, snapshotId)
+
+    def onSnapshotChange(self, machineId, snapshotId):
+        self.bus.publish('onSnapshotChange', machineId, snapshotId)
+
+    def onGuestPropertyChange(self, machineId, name, value, flags):
+        self.bus.publish('onGuestPropertyChange', machineId, name, value, flags)
+
+def register_callback(vbox, bus):
+    """Register a VirtualBoxCallback feeding bus with vbox.
+
+    Callbacks are only delivered while this thread pumps XPCOM events; see
+    EventLoop.
+    The returned XPCOM object must be kept alive for as long as the callback
+    should stay registered; pass it to vbox.unregisterCallback() to stop.
+    """
+    # xpcom can only be imported once vboxweb.py has located VBoxPython.
+    import xpcom.components, xpcom.server
+    iid = xpcom.components.interfaces.IVirtualBoxCallback
+    callback = VirtualBoxCallback(bus)
+    callback._com_interfaces_ = iid
+    wrapped = xpcom.server.WrapObject(callback, iid)
+    vbox.registerCallback(wrapped)
+    return wrapped
+
+class EventLoop:
+    """Delivers VirtualBox callbacks on a thread of their own.
+
+    XPCOM only calls back into Python while the registering thread pumps its
+    event queue, which CherryPy threads never do. The loop thread registers
+    the callback and then waits for events in timeout millisecond slices, so
+    a callback is picked up at most that long after VBoxSVC sends it. The
+    callback only queues the event; a second thread publishes it on the bus,
+    so slow subscribers never hold up the XPCOM queue.
+    """
+
+    def __init__(self, vbox, bus, timeout=100, register_timeout=10):
+        self.vbox = vbox
+        self.bus = bus
+        self.timeout = timeout
+        self.register_timeout = register_timeout
+        self.queue = Queue.Queue()
+        self.running = False
+        self.pumping = False
+        self.registered = threading.Event()
+        self.error = None
+        self.lock = threading.Lock()
+        self.delivered = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def start(self):
+        """Start both threads and wait until the callback is registered.
+
+        Returns False if callbacks will not be delivered, either because
+        registration failed (self.error says why) or because this VirtualBox
+        has no way to pump XPCOM events, or because registering took longer
+        than register_timeout seconds.
+        """
+        self.running = True
+        for target, name in ((self._pump, 'vboxweb-xpcom-events'),
+                             (self._dispatch, 'vboxweb-event-dispatch')):
+            thread = threading.Thread(target=target, name=name)
+            thread.setDaemon(True)
+            thread.start()
+        self.registered.wait(self.register_timeout)
+        if not self.registered.isSet():
+            # The pump thread unregisters if it ever gets that far.
+            self.error = "Timed out registering the VirtualBox callback"
+            logger.error(self.error)
+            self.running = False
+        return self.error is None and self.pumping
+
+    def stop(self):
+        self.running = False
+
+    def publish(self, topic, *args):
+        # Called by the VirtualBoxCallback on the pump thread.
+        self.queue.put((topic, args, time.time()))
+
+    def _pump(self):
+        import xpcom
+        wait_for_events = getattr(xpcom._xpcom, 'WaitForEvents', None)
+        if wait_for_events is None:
+            # Nothing could ever service a registered callback.
+            self.error = "This VirtualBox has no WaitForEvents()"
+            logger.warning("%s; callbacks will not be delivered", self.error)
+            self.running = False
+            self.registered.set()
+            return
+        self.pumping = True
+        try:
+            callback = register_callback(self.vbox, self)
+        except Exception, e:
+            self.error = str(e)
+            logger.error("Unable to register VirtualBox callback: %s", e)
+            self.running = False
+            self.registered.set()
+            return
+        self.registered.set()
+        try:
+            while self.running:
+                wait_for_events(self.timeout)
+        finally:
+            try:
+                self.vbox.unregisterCallback(callback)
+            except Exception:
+                pass
+
+    def _dispatch(self):
+        while True:
+            topic, args, received = self.queue.get()
+            self.bus.publish(topic, *args)
+            latency = time.time() - received
+            self.lock.acquire()
+            try:
+                self.delivered += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+            finally:
+                self.lock.release()
+
+    def stats(self):
+        """Events delivered, and seconds from receipt to the last subscriber."""
+        self.lock.acquire()
+        try:
+            mean = 0.0
+            if self.delivered:
+                mean = self.total_latency / self.delivered
+            return {'registered': self.error is None, 'delivered': self.delivered,
+                    'queued': self.queue.qsize(), 'mean_latency': mean,
+                    'max_latency': self.max_latency, 'pump_interval': self.timeout / 1000.0}
+        finally:
+            self.lock.release()
+
+# MachineState values a machine only passes through: Starting, Stopping,
+# Saving, Restoring, Discarding and SettingUp.
+TRANSITIONAL_STATES = (7, 8, 9, 10, 11, 12)
+
+class _PolledMachine:
+
+    def __init__(self, machine, state, last_change):
+        self.machine = machine
+        self.state = state
+        self.last_change = last_change
+        self.due = 0
+
+class StatePoller:
+    """Publishes machine state changes by polling, for when callbacks fail.
+
+    Each machine's lastStateChange is read every fast seconds while it is in
+    a transitional state and every slow seconds otherwise, and its state is
+    only read again when that has moved. The machine list is re-read every
+    rescan seconds to notice registrations. Any onMachineDataChange on the
+    bus, e.g. a control job finishing, gets that machine polled at once.
+    """
+
+    def __init__(self, vbox, bus, fast=1.0, slow=30.0, rescan=60.0):
+        self.vbox = vbox
+        self.bus = bus
+        self.fast = fast
+        self.slow = slow
+        self.rescan = rescan
+        self.cond = threading.Condition()
+        self.machines = {} # _PolledMachine keyed by uuid
+        self.scanned = False
+        self.polls = 0
+        self.started = None
+        bus.subscribe('onMachineDataChange', self.poll_soon)
+
+    def start(self):
+        self.started = time.time()
+        thread = threading.Thread(target=self._run, name='vboxweb-state-poller')
+        thread.setDaemon(True)
+        thread.start()
+
+    def poll_soon(self, uuid):
+        self.cond.acquire()
+        try:
+            polled = self.machines.get(uuid)
+            if polled is not None:
+                polled.due = 0
+                self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def _interval(self, state):
+        if state in TRANSITIONAL_STATES:
+            return self.fast
+        return self.slow
+
+    def _scan(self):
+        found = {}
+        for machine in self.vbox.getMachines():
+            uuid = machine.id
+            polled = self.machines.get(uuid)
+            if polled is None:
+                polled = _PolledMachine(machine, int(machine.state), machine.lastStateChange)
+                polled.due = time.time() + self._interval(polled.state)
+                if self.scanned:
+                    self.bus.publish('onMachineRegistered', uuid, True)
+            found[uuid] = polled
+        for uuid in self.machines:
+            if uuid not in found:
+                self.bus.publish('onMachineRegistered', uuid, False)
+        self.cond.acquire()
+        try:
+            self.machines = found
+            self.scanned = True
+        finally:
+            self.cond.release()
+
+    def _poll(self, uuid, polled):
+        self.polls += 1
+        last_change = polled.machine.lastStateChange
+        if last_change != polled.last_change:
+            polled.last_change = last_change
+            polled.state = int(polled.machine.state)
+            self.bus.publish('onMachineStateChange', uuid, polled.state)
+        polled.due = time.time() + self._interval(polled.state)
+
+    def _run(self):
+        next_scan = 0
+        while True:
+            try:
+                if time.time() >= next_scan:
+                    self._scan()
+                    next_scan = time.time() + self.rescan
+                self.cond.acquire()
+                try:
+                    due = [(uuid, polled) for uuid, polled in self.machines.items()
+                           if polled.due <= time.time()]
+                    if not due:
+                        wake = min([polled.due for polled in self.machines.values()] + [next_scan])
+                        self.cond.wait(max(0, wake - time.time()))
+                finally:
+                    self.cond.release()
+                for uuid, polled in due:
+                    self._poll(uuid, polled)
+            except Exception:
+                # Machines can disappear between scans; rescan and carry on.
+                logger.exception("Machine state poll failed")
+                next_scan = 0
+                time.sleep(self.fast)
+
+    def stats(self):
+        """Total polls, and polls per second since start()."""
+        rate = 0.0
+        if self.started is not None and time.time() > self.started:
+            rate = self.polls / (time.time() - self.started)
+        return {'machines': len(self.machines), 'polls': self.polls, 'rate': rate}
+
+class EventStream:
+    """Fans machine changes out to any number of browsers as server-sent events.
+
+    Subscribe it to an EventBus: each notification is encoded once
+    into a short backlog, and every /events client just waits for entries
+    newer than the last one it sent, so clients cost no XPCOM calls. A client
+    is disconnected after duration seconds to free its CherryPy thread; the
+    browser reconnects and picks up where it left off using Last-Event-ID.
+    Event ids are "<epoch>-<number>", with an epoch unique to this process,
+    so a browser that reconnects to a restarted server is told to reset.
+
+    Every listener holds a CherryPy thread, so at most max_listeners are
+    admitted at once; keep it well below server.thread_pool.
+    """
+
+    def __init__(self, state_names, backlog=200, duration=55, keepalive=15, max_listeners=10):
+        self.state_names = state_names
+        self.max_listeners = max_listeners
+        self.listeners = 0
+        self.backlog = backlog
+        self.duration = duration
+        self.keepalive = keepalive
+        self.cond = threading.Condition()
+        self.events = [] # (number, name, encoded data), oldest first
+        self.last_id = 0
+        self.epoch = '%x' % (int(time.time() * 1000),)
+
+    def publish(self, name, data):
+        encoded = simplejson.dumps(data)
+        self.cond.acquire()
+        try:
+            self.last_id += 1
+            self.events.append((self.last_id, name, encoded))
+            del self.events[:-self.backlog]
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def _since(self, last_id):
+        # Return the events after last_id, or None if the client can't catch
+        # up: some have been dropped, or last_id is from before a restart.
+        if last_id > self.last_id or (last_id and not self.events):
+            return None
+        if self.events and self.events[0][0] > last_id + 1:
+            return None
+        return [event for event in self.events if event[0] > last_id]
+
+    def _wait(self, last_id, timeout):
+        self.cond.acquire()
+        try:
+            events = self._since(last_id)
+            if events == []:
+                self.cond.wait(timeout)
+                events = self._since(last_id)
+            return events
+        finally:
+            self.cond.release()
+
+    def _parse_id(self, event_id):
+        # The event number in an id this process sent, or None.
+        try:
+            epoch, number = event_id.split('-')
+            number = int(number)
+        except (AttributeError, ValueError):
+            return None
+        if epoch != self.epoch:
+            return None
+        return number
+
+    def admit(self):
+        """Count in a new listener, or return False if there are already
+        max_listeners. Every admitted client must be let go with release()
+        once its request is over, whether or not listen() was consumed."""
+        self.cond.acquire()
+        try:
+            if self.listeners >= self.max_listeners:
+                return False
+            self.listeners += 1
+            return True
+        finally:
+            self.cond.release()
+
+    def release(self):
+        self.cond.acquire()
+        try:
+            self.listeners -= 1
+        finally:
+            self.cond.release()
+
+    def listen(self, last_event_id=None):
+        """Generate the text/event-stream body for one client, starting after
+        last_event_id or, if that is None, with the next event."""
+        if last_event_id is None:
+            last_id = self.last_id
+        else:
+            last_id = self._parse_id(last_event_id)
+        deadline = time.time() + self.duration
+        yield 'retry: 1000\n\n'
+        while time.time() < deadline:
+            if last_id is None:
+                events = None
+            else:
+                events = self._wait(last_id, self.keepalive)
+            if events is None:
+                # The client missed too much, or is from before a restart;
+                # it should reload the page.
+                last_id = self.last_id
+                yield 'id: %s-%d\nevent: reset\ndata: {}\n\n' % (self.epoch, last_id)
+            elif not events:
+                yield ': keepalive\n\n'
+            for number, name, data in events or ():
+                last_id = number
+                yield 'id: %s-%d\nevent: %s\ndata: %s\n\n' % (self.epoch, number, name, data)
+
+    def stats(self):
+        return {'listeners': self.listeners, 'max_listeners': self.max_listeners,
+                'last_id': self.last_id}
+
+    # EventBus handlers, see EventBus.subscribe_listener().
+
+    def onMachineStateChange(self, machineId, state):
+        state = int(state)
+        self.publish('state', {'uuid': machineId, 'state': state,
+                               'state_name': self.state_names[state]})
+
+    def onMachineDataChange(self, machineId):
+        self.publish('machine', {'uuid': machineId})
+
+    def onMachineRegistered(self, machineId, registered):
+        self.publish('registered', {'uuid': machineId, 'registered': bool(registered)})
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+#
+# The MIT License
+#
+# Copyright (c) 2009 Josh Wright
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# ***** END LICENSE BLOCK *****
+
+import sys, threading, time, Queue
+
+class Future:
+    """The eventual result of a call submitted to an XPCOMExecutor."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+    def get(self, timeout=None):
+        """Wait for the call to finish and return its result, or re-raise its exception."""
+        self.done.wait(timeout)
+        if not self.done.isSet():
+            raise RuntimeError, "XPCOM call did not finish within %s seconds" % (timeout,)
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+
+class XPCOMExecutor:
+    """A small fixed pool of threads that make every XPCOM call.
+
+    Other threads queue calls with submit() or call() and wait on the
+    result. Calls made from a pool thread run inline.
+
+    vboxweb.py routes the web handlers and the VM control jobs through
+    XPCOMProxy objects onto one of these. The progress reactor, the event
+    loop and the state poller keep making their own calls on their own
+    threads, since they block in XPCOM waits by design.
+    """
+
+    def __init__(self, threads=2):
+        self.queue = Queue.Queue()
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.wait_time = 0.0 # seconds spent queued
+        self.service_time = 0.0 # seconds spent running
+        for i in range(threads):
+            thread = threading.Thread(target=self._work, name='vboxweb-xpcom-%d' % (i,))
+            thread.setDaemon(True)
+            thread.start()
+        self.threads = threads
+
+    def submit(self, function, *args, **kw):
+        future = Future()
+        if getattr(self.local, 'worker', False):
+            self._run(future, function, args, kw)
+        else:
+            self.queue.put((future, function, args, kw, time.time()))
+        return future
+
+    def call(self, function, *args, **kw):
+        return self.submit(function, *args, **kw).get()
+
+    def _run(self, future, function, args, kw):
+        try:
+            future.result = function(*args, **kw)
+        except:
+            future.exc_info = sys.exc_info()
+        future.done.set()
+
+    def _work(self):
+        self.local.worker = True
+        while True:
+            future, function, args, kw, queued = self.queue.get()
+            started = time.time()
+            self._run(future, function, args, kw)
+            finished = time.time()
+            self.lock.acquire()
+            try:
+                self.calls += 1
+                self.wait_time += started - queued
+                self.service_time += finished - started
+            finally:
+                self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            calls = max(self.calls, 1)
+            return {'threads': self.threads, 'queued': self.queue.qsize(),
+                    'calls': self.calls, 'mean_wait': self.wait_time / calls,
+                    'mean_service': self.service_time / calls}
+        finally:
+            self.lock.release()
+
+def unwrap(value):
+    """The object behind an XPCOMProxy, or value itself if it is not one."""
+    if isinstance(value, XPCOMProxy):
+        return value.__dict__['_target_']
+    if isinstance(value, (list, tuple)):
+        return type(value)([unwrap(item) for item in value])
+    return value
+
+def _wrap(value, executor):
+    import xpcom.client
+    # XPCOM wrappers and methods stay behind a proxy; plain data is returned as is.
+    if isinstance(value, (list, tuple)):
+        return type(value)([_wrap(item, executor) for item in value])
+    if value is None or isinstance(value, (basestring, int, long, float, bool, dict)):
+        return value
+    if isinstance(value, xpcom.client._XPCOMBase) or callable(value):
+        return XPCOMProxy(value, executor)
+    return value
+
+class XPCOMProxy:
+    """Stands in for an object, doing every attribute access, assignment and
+    call on it through an XPCOMExecutor.
+
+    XPCOM objects and methods it returns are proxied in turn, and proxies
+    passed back in as arguments are unwrapped first.
+    """
+
+    def __init__(self, target, executor):
+        self.__dict__['_target_'] = target
+        self.__dict__['_executor_'] = executor
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError, attr
+        executor = self.__dict__['_executor_']
+        return _wrap(executor.call(getattr, self.__dict__['_target_'], attr), executor)
+
+    def __setattr__(self, attr, val):
+        self.__dict__['_executor_'].call(setattr, self.__dict__['_target_'], attr, unwrap(val))
+
+    def __call__(self, *args, **kw):
+        executor = self.__dict__['_executor_']
+        args = unwrap(args)
+        for key in kw:
+            kw[key] = unwrap(kw[key])
+        return _wrap(executor.call(self.__dict__['_target_'], *args, **kw), executor)
+
+    def __repr__(self):
+        return '<XPCOMProxy for %r>' % (self.__dict__['_target_'],)
+
+xpcom_executor = None
+
+def configure(threads):
+    """Create the shared executor, or disable it if threads is 0."""
+    global xpcom_executor
+    if threads:
+        xpcom_executor = XPCOMExecutor(threads)
+    else:
+        xpcom_executor = None
+    return xpcom_executor
+
+def executor_stats():
+    if xpcom_executor is None:
+        return None
+    return xpcom_executor.stats()
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+#
+# The MIT License
+#
+# Copyright (c) 2009 Josh Wright
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# ***** END LICENSE BLOCK *****
+
+import threading, time
+from xpcom import COMException
+
+class MachineRecord:
+    """Plain Python copy of the IMachine properties shown in VM listings.
+
+    Attribute names mirror IMachine so templates work with either."""
+
+    def __init__(self, id, name, state, OSTypeId):
+        self.id = id
+        self.name = name
+        self.state = state
+        self.OSTypeId = OSTypeId
+
+    def __repr__(self):
+        return '<MachineRecord %s (%s)>' % (self.name, self.id)
+
+def read_machine(vm):
+    id, name, state, os_type_id = vm.get_many(('id', 'name', 'state', 'OSTypeId'))
+    return MachineRecord(id, name, int(state), os_type_id)
+
+class Record:
+    """Read-only bag of attributes."""
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+    def __setattr__(self, attr, val):
+        raise AttributeError, "%s attributes are read-only" % (self.__class__.__name__,)
+
+class MachineSnapshot(Record):
+    """Everything vm/info.html shows about a machine, read in one pass.
+
+    Build one with snapshot_machine(); xpcom_calls is the number of XPCOM
+    getter and method calls that took."""
+
+    def __repr__(self):
+        return '<MachineSnapshot %s (%s)>' % (self.name, self.id)
+
+MACHINE_FIELDS = ('id', 'name', 'description', 'OSTypeId', 'memorySize',
+                  'VRAMSize', 'HWVirtExEnabled', 'HWVirtExNestedPagingEnabled',
+                  'PAEEnabled', 'accelerate3DEnabled')
+BIOS_FIELDS = ('ACPIEnabled', 'IOAPICEnabled')
+DRIVE_FIELDS = ('state',)
+AUDIO_FIELDS = ('enabled', 'audioDriver', 'audioController')
+HARD_DISK_FIELDS = ('id', 'name', 'format', 'logicalSize', 'type')
+SHARED_FOLDER_FIELDS = ('name', 'hostPath', 'accessible', 'writable')
+
+class _Reader:
+    # Copies XPCOM properties into Python data, counting the calls made.
+
+    def __init__(self):
+        self.calls = 0
+
+    def get(self, ob, name):
+        self.calls += 1
+        return getattr(ob, name)
+
+    def call(self, method, *args):
+        self.calls += 1
+        return method(*args)
+
+    def record(self, ob, names):
+        self.calls += len(names)
+        return Record(**dict(zip(names, ob.get_many(names))))
+
+def snapshot_machine(vm, max_boot_position):
+    reader = _Reader()
+    fields = reader.record(vm, MACHINE_FIELDS).__dict__.copy()
+    fields['state'] = int(reader.get(vm, 'state'))
+    fields['BIOSSettings'] = reader.record(reader.get(vm, 'BIOSSettings'), BIOS_FIELDS)
+    fields['DVDDrive'] = reader.record(reader.get(vm, 'DVDDrive'), DRIVE_FIELDS)
+    fields['floppyDrive'] = reader.record(reader.get(vm, 'floppyDrive'), DRIVE_FIELDS)
+    fields['audioAdapter'] = reader.record(reader.get(vm, 'audioAdapter'), AUDIO_FIELDS)
+    boot_order = []
+    for position in range(1, max_boot_position + 1):
+        device = reader.call(vm.getBootOrder, position)
+        if device != 0:
+            boot_order.append(device)
+    fields['bootOrder'] = tuple(boot_order)
+    attachments = []
+    for attachment in reader.call(vm.getHardDiskAttachments):
+        hard_disk = reader.record(reader.get(attachment, 'hardDisk'), HARD_DISK_FIELDS)
+        attachments.append(Record(hardDisk=hard_disk))
+    fields['hardDiskAttachments'] = tuple(attachments)
+    shared_folders = []
+    for shared_folder in reader.call(vm.getSharedFolders):
+        shared_folders.append(reader.record(shared_folder, SHARED_FOLDER_FIELDS))
+    fields['sharedFolders'] = tuple(shared_folders)
+    fields['xpcom_calls'] = reader.calls
+    return MachineSnapshot(**fields)
+
+class InventoryCache:
+    """Shared list of MachineRecords for every registered machine.
+
+    Records are kept current by the VirtualBox events below (subscribe the
+    cache to an events.EventBus). Should callbacks stop
+    arriving, the whole inventory is re-read once it is max_age seconds old.
+    """
+
+    def __init__(self, vbox, max_age=30):
+        self.vbox = vbox
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.records = {} # keyed by machine uuid
+        self.order = [] # uuids in getMachines() order
+        self.dirty = set() # uuids whose record must be re-read
+        self.loaded_at = None
+
+    def machines(self):
+        self.lock.acquire()
+        try:
+            self._refresh()
+            return [self.records[uuid] for uuid in self.order]
+        finally:
+            self.lock.release()
+
+    def get(self, uuid):
+        """Return the record for one machine, or None if it isn't registered."""
+        self.lock.acquire()
+        try:
+            self._refresh()
+            return self.records.get(uuid)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, uuid=None):
+        """Forget one machine's record, or the whole inventory if uuid is None."""
+        self.lock.acquire()
+        try:
+            if uuid is None:
+                self.loaded_at = None
+            else:
+                self.dirty.add(uuid)
+        finally:
+            self.lock.release()
+
+    def _refresh(self):
+        if self.loaded_at is None or time.time() - self.loaded_at > self.max_age:
+            self._reload()
+        elif self.dirty:
+            self._refresh_dirty()
+
+    def _reload(self):
+        records = {}
+        order = []
+        for vm in self.vbox.getMachines():
+            record = read_machine(vm)
+            records[record.id] = record
+            order.append(record.id)
+        self.records = records
+        self.order = order
+        self.dirty.clear()
+        self.loaded_at = time.time()
+
+    def _refresh_dirty(self):
+        for uuid in self.dirty:
+            try:
+                record = read_machine(self.vbox.getMachine(uuid))
+            except COMException:
+                # The machine has gone away since it was flagged.
+                self._forget(uuid)
+                continue
+            if uuid not in self.records:
+                self.order.append(uuid)
+            self.records[uuid] = record
+        self.dirty.clear()
+
+    def _forget(self, uuid):
+        self.records.pop(uuid, None)
+        if uuid in self.order:
+            self.order.remove(uuid)
+
+    # EventBus handlers, see events.EventBus.subscribe_listener().
+
+    def onMachineStateChange(self, machineId, state):
+        self.lock.acquire()
+        try:
+            old = self.records.get(machineId)
+            if old is not None:
+                self.records[machineId] = MachineRecord(old.id, old.name, int(state), old.OSTypeId)
+        finally:
+            self.lock.release()
+
+    def onMachineDataChange(self, machineId):
+        self.invalidate(machineId)
+
+    def onMachineRegistered(self, machineId, registered):
+        if registered:
+            self.invalidate(machineId)
+        else:
+            self.lock.acquire()
+            try:
+                self.dirty.discard(machineId)
+                self._forget(machineId)
+            finally:
+                self.lock.release()
+
+class Generations:
+    """Change counters for machines and the media registry, used as ETags.
+
+    Every change takes the next value of a single counter, so each
+    generation only ever grows. Like InventoryCache, this is fed from the
+    EventBus; in case callbacks stop arriving, etag() also folds in
+    the current max_age second window so no ETag stays valid for longer.
+    The counter starts again at 0 in a new process, so every ETag also
+    carries a token for this process.
+    """
+
+    def __init__(self, max_age=30):
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.machine_generations = {} # keyed by machine uuid
+        self.inventory = 0 # last change to any machine
+        self.media = 0 # last change to the media registry
+        self.token = '%x' % (int(time.time() * 1000),)
+
+    def machine(self, uuid):
+        return self.machine_generations.get(uuid, 0)
+
+    def etag(self, *generations):
+        window = int(time.time() // self.max_age)
+        return '"%s-%s"' % (self.token, '-'.join([str(generation) for generation in generations + (window,)]))
+
+    def machine_changed(self, uuid):
+        self.lock.acquire()
+        try:
+            self.counter += 1
+            self.machine_generations[uuid] = self.inventory = self.counter
+        finally:
+            self.lock.release()
+
+    def media_changed(self):
+        self.lock.acquire()
+        try:
+            self.counter += 1
+            self.media = self.counter
+        finally:
+            self.lock.release()
+
+    # EventBus handlers, see events.EventBus.subscribe_listener().
+
+    def onMachineStateChange(self, machineId, state):
+        self.machine_changed(machineId)
+
+    def onMachineDataChange(self, machineId):
+        self.machine_changed(machineId)
+
+    def onMachineRegistered(self, machineId, registered):
+        self.machine_changed(machineId)
+
+    def onMediaRegistered(self, mediaId, mediaType, registered):
+        self.media_changed()
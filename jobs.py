@@ -0,0 +1,455 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+#
+# The MIT License
+#
+# Copyright (c) 2009 Josh Wright
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# ***** END LICENSE BLOCK *****
+
+import threading, time, itertools, Queue, logging
+from xpcom import COMException
+from executor import unwrap
+
+logger = logging.getLogger('vboxweb')
+
+CONTROL_ACTIONS = ('power_up', 'power_off', 'reset', 'pause', 'save_state', 'resume')
+# MachineState values console.saveState() accepts: Running and Paused.
+SAVEABLE_STATES = (4, 5)
+
+def start_control(sessions, vbox, action, uuid):
+    """Open a session on machine uuid and start action on it.
+
+    Returns (session, progress). progress is None for actions that finish
+    before returning; otherwise the session must stay open until it completes.
+    Either way the session goes back to the sessions pool when done with.
+    """
+    session = sessions.getSessionObject(vbox)
+    try:
+        if action == 'power_up':
+            return session, vbox.openRemoteSession(session, uuid, 'vrdp', '')
+        vbox.openExistingSession(session, uuid)
+        console = session.console
+        progress = None
+        if action == 'power_off':
+            console.powerDown()
+        elif action == 'reset':
+            console.reset()
+        elif action == 'pause':
+            console.pause()
+        elif action == 'save_state':
+            progress = console.saveState()
+        elif action == 'resume':
+            console.resume()
+    except:
+        sessions.releaseSessionObject(session)
+        raise
+    return session, progress
+
+def unique(uuids):
+    """uuids in their original order, without repeats."""
+    seen = set()
+    ret = []
+    for uuid in uuids:
+        if uuid not in seen:
+            seen.add(uuid)
+            ret.append(uuid)
+    return ret
+
+def progress_error(progress):
+    """Return the error text of a completed IProgress, or None if it succeeded."""
+    if progress.resultCode == 0:
+        return None
+    try:
+        return progress.errorInfo.text
+    except (COMException, AttributeError):
+        return "Operation failed with result code 0x%x" % (progress.resultCode & 0xFFFFFFFF,)
+
+class _Watch:
+
+    def __init__(self, progress, on_complete, on_update):
+        self.progress = progress
+        self.on_complete = on_complete
+        self.on_update = on_update
+
+class ProgressReactor:
+    """Follows any number of IProgress objects from a single thread.
+
+    Each pass round-robins over every watched progress with a short
+    waitForCompletion() so a pass takes about round_time milliseconds no
+    matter how many operations are in flight. on_update(percent) is called
+    after each check and on_complete(error) once the operation is over, where
+    error is None on success. Both run on the reactor thread.
+    """
+
+    def __init__(self, round_time=500):
+        self.round_time = round_time
+        self.cond = threading.Condition()
+        self.watches = []
+        thread = threading.Thread(target=self._run, name='vboxweb-progress')
+        thread.setDaemon(True)
+        thread.start()
+
+    def watch(self, progress, on_complete, on_update=None):
+        self.cond.acquire()
+        try:
+            self.watches.append(_Watch(progress, on_complete, on_update))
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def pending(self):
+        return len(self.watches)
+
+    def _run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.watches:
+                    self.cond.wait()
+                watches = list(self.watches)
+            finally:
+                self.cond.release()
+            timeout = max(1, self.round_time // len(watches))
+            for watch in watches:
+                error = self._check(watch, timeout)
+                if error is False:
+                    continue
+                self.cond.acquire()
+                try:
+                    self.watches.remove(watch)
+                finally:
+                    self.cond.release()
+                self._call(watch.on_complete, error)
+
+    def _check(self, watch, timeout):
+        # Returns False while the operation is still running, otherwise its error.
+        progress = watch.progress
+        try:
+            progress.waitForCompletion(timeout)
+            if watch.on_update is not None:
+                self._call(watch.on_update, progress.percent)
+            if not progress.completed:
+                return False
+            return progress_error(progress)
+        except COMException, e:
+            return str(e)
+
+    def _call(self, callback, *args):
+        try:
+            callback(*args)
+        except Exception:
+            logger.exception("Progress callback %r failed", callback)
+
+class Job:
+
+    def __init__(self, id, action, uuid, on_finish=None):
+        self.id = id
+        self.action = action
+        self.uuid = uuid
+        self.on_finish = on_finish
+        self.status = 'queued' # then 'running', 'done' or 'failed'
+        self.percent = 0
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+
+    def finish(self, error=None):
+        self.error = error
+        if error is None:
+            self.status = 'done'
+            self.percent = 100
+        else:
+            self.status = 'failed'
+        self.finished = time.time()
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+    def status_dict(self):
+        return {'id': self.id, 'action': self.action, 'uuid': self.uuid,
+                'status': self.status, 'percent': self.percent,
+                'error': self.error}
+
+def _iter_finished(finished, count):
+    for i in range(count):
+        yield finished.get()
+
+class JobManager:
+    """Runs VM control actions in the background.
+
+    submit() returns at once with a Job that the web layer can look up by id.
+    A worker thread opens the session and starts the action; long running
+    operations are then handed to the ProgressReactor, which closes the
+    session when they complete. Finished jobs are forgotten after keep seconds.
+    If bus is given, onMachineDataChange is published on it for the machine
+    once each job is over.
+    """
+
+    def __init__(self, sessions, vbox, reactor, bus=None, workers=4, keep=300):
+        self.sessions = sessions
+        self.vbox = vbox
+        self.reactor = reactor
+        self.bus = bus
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.jobs = {} # keyed by job id
+        self.ids = itertools.count(1)
+        self.queue = Queue.Queue()
+        for i in range(workers):
+            worker = threading.Thread(target=self._work, name='vboxweb-job-%d' % (i,))
+            worker.setDaemon(True)
+            worker.start()
+
+    def submit(self, action, uuid, on_finish=None):
+        """Queue action for machine uuid. on_finish(job) is called once it is over."""
+        if action not in CONTROL_ACTIONS:
+            raise ValueError, "Unknown VM action '%s'" % (action,)
+        def finished(job):
+            if self.bus is not None:
+                self.bus.publish('onMachineDataChange', job.uuid)
+            if on_finish is not None:
+                on_finish(job)
+        self.lock.acquire()
+        try:
+            self._prune()
+            job = Job(str(self.ids.next()), action, uuid, finished)
+            self.jobs[job.id] = job
+        finally:
+            self.lock.release()
+        self.queue.put(job)
+        return job
+
+    def submit_many(self, action, uuids):
+        """Queue action for every machine in uuids.
+
+        Returns an iterator that yields each Job as it finishes, in completion
+        order. At most `workers` sessions are being opened at any one time.
+        """
+        if action not in CONTROL_ACTIONS:
+            raise ValueError, "Unknown VM action '%s'" % (action,)
+        uuids = unique(uuids)
+        finished = Queue.Queue()
+        for uuid in uuids:
+            self.submit(action, uuid, finished.put)
+        return _iter_finished(finished, len(uuids))
+
+    def get(self, job_id):
+        self.lock.acquire()
+        try:
+            return self.jobs.get(job_id)
+        finally:
+            self.lock.release()
+
+    def _prune(self):
+        cutoff = time.time() - self.keep
+        for job_id, job in self.jobs.items():
+            if job.finished is not None and job.finished < cutoff:
+                del self.jobs[job_id]
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            job.status = 'running'
+            try:
+                self._start(job)
+            except Exception, e:
+                # Keep the worker alive whatever went wrong.
+                job.finish(str(e))
+
+    def _start(self, job):
+        session, progress = start_control(self.sessions, self.vbox, job.action, job.uuid)
+        if progress is None:
+            self.sessions.releaseSessionObject(session)
+            job.finish()
+            return
+        def on_update(percent):
+            job.percent = percent
+        def on_complete(error):
+            try:
+                self.sessions.releaseSessionObject(session)
+            finally:
+                job.finish(error)
+        # The reactor blocks in waitForCompletion(), which must not hold up
+        # an executor thread.
+        self.reactor.watch(unwrap(progress), on_complete, on_update)
+
+class ThrottledRun:
+    """Runs one action over many machines, at most max_active at a time.
+
+    machines is a list of (uuid, memory size) pairs, started in order, and
+    errors a list of (uuid, error) pairs for machines that already failed.
+    Iterating over the run yields each Job as it finishes.
+    """
+
+    def __init__(self, jobs, action, machines, max_active, errors=()):
+        if max_active < 1:
+            raise ValueError, "At least one machine must be allowed to run at a time"
+        self.jobs = jobs
+        self.action = action
+        self.max_active = max_active
+        self.lock = threading.Lock()
+        self.pending = list(machines)
+        self.active = {} # memory size keyed by uuid
+        self.memory = dict(machines)
+        self.count = len(self.pending) + len(errors)
+        self.finished = Queue.Queue()
+        self.started = time.time()
+        self.done = None
+        for uuid, error in errors:
+            self.reject(uuid, error)
+
+    def check(self, memory):
+        """Return why a machine needing memory MB can't start now, or None."""
+        return None
+
+    def elapsed(self):
+        return (self.done or time.time()) - self.started
+
+    def admit(self):
+        self.lock.acquire()
+        try:
+            while self.pending and len(self.active) < self.max_active:
+                uuid, memory = self.pending[0]
+                try:
+                    error = self.check(memory)
+                except COMException, e:
+                    error = str(e)
+                if error is not None:
+                    if self.active:
+                        # Wait for a running job to finish before trying again.
+                        break
+                    self.pending.pop(0)
+                    self.reject(uuid, error)
+                    continue
+                self.pending.pop(0)
+                self.active[uuid] = memory
+                self.jobs.submit(self.action, uuid, self._on_finish)
+        finally:
+            self.lock.release()
+
+    def reject(self, uuid, error):
+        job = Job(None, self.action, uuid)
+        job.finish(error)
+        self.finished.put(job)
+
+    def _on_finish(self, job):
+        self.lock.acquire()
+        try:
+            self.active.pop(job.uuid, None)
+        finally:
+            self.lock.release()
+        self.finished.put(job)
+        self.admit()
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self.finished.get()
+        self.done = time.time()
+
+class BootRun(ThrottledRun):
+    """Powers up machines while the host has their memory free."""
+
+    def __init__(self, vbox, jobs, machines, max_starts, memory_reserve, errors=()):
+        ThrottledRun.__init__(self, jobs, 'power_up', machines, max_starts, errors)
+        self.vbox = vbox
+        self.memory_reserve = memory_reserve
+
+    def check(self, memory):
+        # Machines still starting may not have claimed their memory yet.
+        available = self.vbox.host.memoryAvailable - self.memory_reserve \
+                    - sum(self.active.values())
+        if memory > available:
+            return "Not enough free host memory (%dMB needed, %dMB available)" % (memory, available)
+        return None
+
+class BootScheduler:
+    """Powers up many machines without starting them all at once.
+
+    At most max_starts machines are booting at any time, and a machine is
+    only started if the host has its memorySize free on top of memory_reserve
+    MB and the memory of the machines still starting. The next machine is
+    admitted whenever an earlier power up completes.
+    """
+
+    def __init__(self, vbox, jobs, max_starts=4, memory_reserve=512):
+        self.vbox = vbox
+        self.jobs = jobs
+        self.max_starts = max_starts
+        self.memory_reserve = memory_reserve
+
+    def power_up(self, uuids, max_starts=None):
+        """Start booting uuids in order. Returns a BootRun to follow them with."""
+        if max_starts is None:
+            max_starts = self.max_starts
+        if max_starts < 1:
+            raise ValueError, "max_starts must be at least 1"
+        machines = []
+        errors = []
+        for uuid in unique(uuids):
+            try:
+                machines.append((uuid, self.vbox.getMachine(uuid).memorySize))
+            except COMException, e:
+                errors.append((uuid, str(e)))
+        run = BootRun(self.vbox, self.jobs, machines, max_starts,
+                      self.memory_reserve, errors)
+        run.admit()
+        return run
+
+class DrainRun(ThrottledRun):
+    """Saves the state of machines, tracking how much memory was written."""
+
+    def __init__(self, jobs, machines, max_saves):
+        ThrottledRun.__init__(self, jobs, 'save_state', machines, max_saves)
+        self.saved = 0 # MB of guest memory saved so far
+
+    def _on_finish(self, job):
+        if job.status == 'done':
+            self.lock.acquire()
+            try:
+                self.saved += self.memory[job.uuid]
+            finally:
+                self.lock.release()
+        ThrottledRun._on_finish(self, job)
+
+    def throughput(self):
+        """MB of guest memory saved per second."""
+        elapsed = self.elapsed()
+        if not elapsed:
+            return 0.0
+        return self.saved / elapsed
+
+def drain_host(vbox, jobs, max_saves=2):
+    """Save the state of every running or paused machine.
+
+    At most max_saves saves run at once. Larger machines are saved first so
+    the longest saves overlap with the rest instead of trailing at the end.
+    Returns the DrainRun.
+    """
+    if max_saves < 1:
+        raise ValueError, "max_saves must be at least 1"
+    machines = []
+    for vm in vbox.getMachines():
+        if int(vm.state) in SAVEABLE_STATES:
+            machines.append((vm.id, vm.memorySize))
+    machines.sort(key=lambda machine: machine[1], reverse=True)
+    run = DrainRun(jobs, machines, max_saves)
+    run.admit()
+    return run
@@ -0,0 +1,104 @@
+/*************************
+ * VBoxWeb JavaScript
+ *************************/
+
+// Follow a background VM control job until it finishes, then reload the page.
+function vboxweb_poll_job(job) {
+  if (job.status == 'done') {
+    window.location.reload();
+    return;
+  }
+  if (job.status == 'failed') {
+    $('#xhr_layer .waiting p').text('Failed: ' + job.error);
+    $('#shadow').one('click', function() { window.location.reload(); });
+    return;
+  }
+  $('#xhr_layer .waiting p').text('Please wait... ' + job.percent + '%');
+  setTimeout(function() {
+    $.getJSON('/vm/job/' + job.id, vboxweb_poll_job);
+  }, 1000);
+}
+
+$(function() {
+  $('a.please_wait').click(function() {
+    $('#shadow').addClass('shadow');
+    $('#xhr_layer').addClass('xhr_layer').html(
+      '<div class="waiting"><img src="/media/images/layout/wait.gif" alt=""/><p>Please wait...</p></div>');
+    $.getJSON(this.href, vboxweb_poll_job);
+    return false;
+  });
+});
+
+// Keep the VM list and VM info pages current from the /events stream.
+function vboxweb_machine(uuid) {
+  return $('[data-uuid="' + uuid + '"]');
+}
+
+function vboxweb_show_state(uuid, state_name) {
+  var machine = vboxweb_machine(uuid);
+  machine.find('.vm_state').text(state_name);
+  machine.find('[data-states]').each(function() {
+    var states = $(this).attr('data-states').split('|');
+    $(this).toggle($.inArray(state_name, states) != -1);
+  });
+}
+
+// Open the /events stream.  If the server turns us away because it already
+// has as many listeners as it allows, try again later from the last event
+// we saw.
+function vboxweb_listen(list, info, last_id) {
+  var url = '/events';
+  if (last_id) {
+    url += '?last_id=' + encodeURIComponent(last_id);
+  }
+  var source = new EventSource(url);
+  function seen(e) {
+    if (e.lastEventId) {
+      last_id = e.lastEventId;
+    }
+    return JSON.parse(e.data);
+  }
+  source.addEventListener('state', function(e) {
+    var event = seen(e);
+    vboxweb_show_state(event.uuid, event.state_name);
+  }, false);
+  source.addEventListener('machine', function(e) {
+    var event = seen(e);
+    if (event.uuid == info) {
+      window.location.reload();
+    } else if (list && vboxweb_machine(event.uuid).length) {
+      $.getJSON('/machine/' + event.uuid, function(vm) {
+        var row = vboxweb_machine(vm.id);
+        row.attr('class', vm.OSTypeId.toLowerCase());
+        row.find('.vm_name').text(vm.name);
+        row.find('.vm_os').text(vm.os);
+        vboxweb_show_state(vm.id, vm.state_name);
+      });
+    }
+  }, false);
+  source.addEventListener('registered', function(e) {
+    var event = seen(e);
+    if (list) {
+      window.location.reload();
+    } else if (event.uuid == info && !event.registered) {
+      window.location = '/';
+    }
+  }, false);
+  source.addEventListener('reset', function(e) {
+    window.location.reload();
+  }, false);
+  source.onerror = function() {
+    if (source.readyState == EventSource.CLOSED) {
+      setTimeout(function() { vboxweb_listen(list, info, last_id); }, 30000);
+    }
+  };
+}
+
+$(function() {
+  var list = $('ul.list_vms').length > 0;
+  var info = $('body[data-uuid]').attr('data-uuid');
+  if (!window.EventSource || (!list && !info)) {
+    return;
+  }
+  vboxweb_listen(list, info, null);
+});
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+#
+# The MIT License
+#
+# Copyright (c) 2009 Josh Wright
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# ***** END LICENSE BLOCK *****
+
+import threading, time
+from inventory import Record
+
+SYSTEM_PROPERTY_FIELDS = ('minGuestRAM', 'maxGuestRAM', 'minGuestVRAM', 'maxGuestVRAM',
+                          'maxVDISize', 'networkAdapterCount', 'serialPortCount',
+                          'parallelPortCount', 'maxBootPosition', 'defaultMachineFolder',
+                          'defaultHardDiskFolder', 'defaultHardDiskFormat',
+                          'remoteDisplayAuthLibrary', 'webServiceAuthLibrary',
+                          'HWVirtExEnabled', 'LogHistoryCount')
+
+def read_system_properties(props):
+    fields = {}
+    for name in SYSTEM_PROPERTY_FIELDS:
+        # Not every VirtualBox version has every property.
+        try:
+            fields[name] = getattr(props, name)
+        except AttributeError:
+            fields[name] = None
+    return Record(**fields)
+
+class SystemProperties:
+    """Read-only snapshot of ISystemProperties, shared by all handlers.
+
+    VirtualBox sends no notification when these change, so the snapshot is
+    re-read once it is max_age seconds old. vboxweb never changes them
+    itself, so in practice this is a max_age TTL; anything that does should
+    call invalidate() afterwards.
+    """
+
+    def __init__(self, vbox, max_age=300):
+        self.vbox = vbox
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.current = None
+        self.loaded_at = None
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            if self.current is None or time.time() - self.loaded_at > self.max_age:
+                self.current = read_system_properties(self.vbox.systemProperties)
+                self.loaded_at = time.time()
+            return self.current
+        finally:
+            self.lock.release()
+
+    def invalidate(self):
+        self.lock.acquire()
+        try:
+            self.current = None
+        finally:
+            self.lock.release()
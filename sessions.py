@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+#
+# The MIT License
+#
+# Copyright (c) 2009 Josh Wright
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# ***** END LICENSE BLOCK *****
+
+import threading, time
+from xpcom import COMException
+
+# ISession.state value for a session that can be opened again.
+SESSION_STATE_CLOSED = 1
+
+class SessionPool:
+    """Reuses @virtualbox.org/Session;1 objects instead of creating one per
+    request.
+
+    Stands in for the session manager: getSessionObject() checks a closed
+    session out of the pool, creating one through mgr while fewer than size
+    exist and waiting for a release otherwise. releaseSessionObject() closes
+    the session and puts it back.
+    """
+
+    def __init__(self, mgr, size=32):
+        self.mgr = mgr
+        self.size = size
+        self.cond = threading.Condition()
+        self.idle = []
+        self.created = 0
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def getSessionObject(self, vbox):
+        self.cond.acquire()
+        try:
+            if not self.idle and self.created >= self.size:
+                self.waits += 1
+                started = time.time()
+                while not self.idle and self.created >= self.size:
+                    self.cond.wait()
+                self.wait_time += time.time() - started
+            if self.idle:
+                self.hits += 1
+                return self.idle.pop()
+            self.misses += 1
+            self.created += 1
+        finally:
+            self.cond.release()
+        try:
+            return self.mgr.getSessionObject(vbox)
+        except:
+            self._discard()
+            raise
+
+    def releaseSessionObject(self, session):
+        try:
+            if session.state != SESSION_STATE_CLOSED:
+                session.close()
+            reusable = session.state == SESSION_STATE_CLOSED
+        except COMException:
+            reusable = False
+        if not reusable:
+            self._discard()
+            return
+        self.cond.acquire()
+        try:
+            self.idle.append(session)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def _discard(self):
+        # Forget a session object so a fresh one can take its place.
+        self.cond.acquire()
+        try:
+            self.created -= 1
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def stats(self):
+        return {'size': self.size, 'created': self.created, 'idle': len(self.idle),
+                'hits': self.hits, 'misses': self.misses, 'waits': self.waits,
+                'wait_time': self.wait_time}
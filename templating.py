@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# ***** BEGIN LICENSE BLOCK *****
+#
+# The MIT License
+#
+# Copyright (c) 2009 Josh Wright
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+#
+# ***** END LICENSE BLOCK *****
+
+import os, threading, time
+from genshi.core import Markup, escape
+from genshi.template import TemplateLoader
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+loader = TemplateLoader(TEMPLATE_DIR, auto_reload=True)
+
+timings_lock = threading.Lock()
+timings = {} # [count, total seconds, slowest seconds] keyed by template
+
+def template_names():
+    names = []
+    for dirpath, dirnames, filenames in os.walk(TEMPLATE_DIR):
+        for filename in filenames:
+            if filename.endswith('.html'):
+                path = os.path.join(dirpath, filename)
+                names.append(os.path.relpath(path, TEMPLATE_DIR).replace(os.sep, '/'))
+    names.sort()
+    return names
+
+def configure(production=False):
+    """Set up the template loader.
+
+    In production mode every template is compiled up front and the loader
+    never looks at the filesystem again, so template edits need a restart.
+    """
+    global loader
+    if not production:
+        loader = TemplateLoader(TEMPLATE_DIR, auto_reload=True)
+        return
+    names = template_names()
+    new_loader = TemplateLoader(TEMPLATE_DIR, auto_reload=False,
+                                max_cache_size=max(25, len(names)))
+    for name in names:
+        new_loader.load(name)
+    loader = new_loader
+
+def render(filename, filler=None, **data):
+    """Render a template to an HTML string, timing how long it took."""
+    started = time.time()
+    stream = loader.load(filename).generate(**data)
+    if filler is not None:
+        stream = stream.filter(filler)
+    html = stream.render('html', doctype='html')
+    elapsed = time.time() - started
+    timings_lock.acquire()
+    try:
+        timing = timings.setdefault(filename, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += elapsed
+        timing[2] = max(timing[2], elapsed)
+    finally:
+        timings_lock.release()
+    return html
+
+def render_stats():
+    """Per-template render count, mean and slowest time in seconds."""
+    timings_lock.acquire()
+    try:
+        stats = {}
+        for filename, (count, total, slowest) in timings.items():
+            stats[filename] = {'count': count, 'mean': total / count, 'max': slowest}
+        return stats
+    finally:
+        timings_lock.release()
+
+def options(pairs):
+    """Markup for a run of <option> elements from (value, label) pairs."""
+    return Markup(''.join(['<option value="%s">%s</option>' % (escape(unicode(value)), escape(unicode(label)))
+                           for value, label in pairs]))
+
+class FragmentCache:
+    """Rendered pieces of markup that only change with their key.
+
+    Pages splice the cached Markup into their templates instead of having
+    Genshi generate the same elements on every request.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fragments = {}
+
+    def get(self, key, build):
+        """Return the fragment for key, calling build() to make it if needed."""
+        self.lock.acquire()
+        try:
+            fragment = self.fragments.get(key)
+            if fragment is None:
+                fragment = self.fragments[key] = build()
+            return fragment
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.fragments.clear()
+        finally:
+            self.lock.release()
+
+fragments = FragmentCache()
@@ -25,7 +25,7 @@
 #
 # ***** END LICENSE BLOCK *****
 
-import os, sys, pickle
+import os, sys, pickle, logging
 
 USAGE = """
 
@@ -38,8 +38,32 @@ Usage:
         Set the port number VBoxWeb should listen on
     --vbox-path [path]
         The path to VBoxPython.so (i.e. /usr/lib/virtualbox/)
+    --production
+        Compile all templates at startup and never reload them
+    --development
+        Reload templates from disk when they change (the default)
+    --threads [number]
+        Size of the CherryPy request thread pool (default 30)
+    --max-listeners [number]
+        How many browsers may follow live updates over /events at once; each
+        holds a request thread, so this must be less than --threads
+        (default 10). Browsers over the limit retry every 30 seconds.
     -s, --save-settings
         Save any settings modified with command line arguments
+    --poll
+        Poll machine states even if VirtualBox callbacks are available
+    --xpcom-threads [number]
+        Make the XPCOM calls of web requests and of the VM control jobs they
+        start on this many dedicated threads (default 0, which makes them on
+        the request and job threads). Following job progress, VirtualBox
+        callbacks and state polling still use threads of their own.
+    --build-bindings
+        Write vbox_bindings.py, which saves compiling the VirtualBox interface
+        bindings at every startup, then exit
+    --drain
+        Save the state of every running VM, then exit
+    --max-saves [number]
+        How many VMs --drain saves at the same time (default 2)
 """
 
 try:
@@ -56,9 +80,17 @@ except ImportError:
           """
     sys.exit()
 
-from content import Root, VM, HardDisk
+from content import Root, VM, HardDisk, VM_STATES
+import templating
+from inventory import InventoryCache, Generations
+from catalog import GuestOSCatalog
+from properties import SystemProperties
+from sessions import SessionPool
+from jobs import JobManager, ProgressReactor, BootScheduler, drain_host
+import events
+import executor
 
-DEFAULT_SETTINGS = {'username': 'vboxweb', 'password': 'vboxweb', 'port': 8080, 'vbox_python_path': '/usr/lib/virtualbox'}
+DEFAULT_SETTINGS = {'username': 'vboxweb', 'password': 'vboxweb', 'port': 8080, 'vbox_python_path': '/usr/lib/virtualbox', 'production': False, 'thread_pool': 30, 'max_listeners': 10}
 
 def main(argv):
 
@@ -80,7 +112,15 @@ def main(argv):
 
     port = vboxweb_config['port']
     vbox_python_path = vboxweb_config['vbox_python_path']
+    production = vboxweb_config['production']
+    thread_pool = vboxweb_config['thread_pool']
+    max_listeners = vboxweb_config['max_listeners']
     save_settings = False
+    drain = False
+    max_saves = 2
+    poll = False
+    xpcom_threads = 0
+    build_bindings = False
 
     if len(argv) > 1:
         i = iter(argv)
@@ -90,8 +130,33 @@ def main(argv):
                 port = i.next()
             elif arg == '--vbox-path':
                 vbox_python_path = i.next()
+            elif arg == '--production':
+                production = True
+            elif arg == '--development':
+                production = False
+            elif arg == '--threads':
+                thread_pool = int(i.next())
+            elif arg == '--max-listeners':
+                max_listeners = int(i.next())
             elif arg in ('-s', '--save-settings'):
                 save_settings = True
+            elif arg == '--poll':
+                poll = True
+            elif arg == '--xpcom-threads':
+                xpcom_threads = int(i.next())
+            elif arg == '--build-bindings':
+                build_bindings = True
+            elif arg == '--drain':
+                drain = True
+            elif arg == '--max-saves':
+                try:
+                    max_saves = int(i.next())
+                except ValueError:
+                    max_saves = 0
+                if max_saves < 1:
+                    print "\n--max-saves must be a whole number of at least 1"
+                    print USAGE
+                    sys.exit(1)
             elif arg in ('-h', '--help'):
                 print USAGE
                 sys.exit(0)
@@ -100,9 +165,17 @@ def main(argv):
                 print USAGE
                 sys.exit(1)
 
+    if max_listeners < 0 or max_listeners >= thread_pool:
+        print "\n--max-listeners must be at least 0 and less than --threads (%d)" % (thread_pool,)
+        print USAGE
+        sys.exit(1)
+
     if save_settings:
         vboxweb_config['port'] = port
         vboxweb_config['vbox_python_path'] = vbox_python_path
+        vboxweb_config['production'] = production
+        vboxweb_config['thread_pool'] = thread_pool
+        vboxweb_config['max_listeners'] = max_listeners
         f = open('config.pkl', 'w')
         pickle.dump(vboxweb_config, f, 1)
         f.close()
@@ -111,14 +184,68 @@ def main(argv):
     import xpcom.vboxxpcom
     import xpcom
     import xpcom.components
+    import bindings
+
     vbox = xpcom.components.classes["@virtualbox.org/VirtualBox;1"].createInstance()
 
+    bindings_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'vbox_bindings.py')
+    if build_bindings:
+        try:
+            written, skipped = bindings.write_bindings(bindings_path, vbox_python_path, vbox.version)
+        except ValueError, why:
+            print why
+            sys.exit(1)
+        print "Wrote bindings for %d interfaces to %s" % (len(written), bindings_path)
+        if skipped:
+            print "Skipped %d that could not be described: %s" % (len(skipped), ', '.join(skipped))
+        sys.exit(0)
+    if os.path.exists(bindings_path):
+        import vbox_bindings
+        if bindings.load_bindings(vbox_bindings, vbox_python_path, vbox.version) is None:
+            print "vbox_bindings.py does not match the installed VirtualBox, run with --build-bindings"
+
     class LocalManager:
         def getSessionObject(self, vbox):
             return xpcom.components.classes["@virtualbox.org/Session;1"].createInstance()
 
+    # Everything the web handlers and control jobs touch goes through
+    # web_vbox and web_manager, which are proxies onto the XPCOM threads if
+    # enabled.
+    web_vbox = vbox
+    web_manager = LocalManager()
+    xpcom_executor = executor.configure(xpcom_threads)
+    if xpcom_executor is not None:
+        web_vbox = executor.XPCOMProxy(vbox, xpcom_executor)
+        web_manager = executor.XPCOMProxy(web_manager, xpcom_executor)
+
+    inventory = InventoryCache(web_vbox)
+    generations = Generations()
+    event_stream = events.EventStream(VM_STATES, max_listeners=max_listeners)
+    bus = events.EventBus()
+    for listener in (inventory, generations, event_stream):
+        bus.subscribe_listener(listener)
+
+    # The pool itself is not proxied, so waiting for a free session never
+    # ties up an XPCOM thread; the sessions it hands out are.
+    sessions = SessionPool(web_manager)
+    reactor = ProgressReactor()
+    jobs = JobManager(sessions, web_vbox, reactor, bus)
+
+    if drain:
+        run = drain_host(web_vbox, jobs, max_saves)
+        print "Saving %d running VMs, %d at a time" % (run.count, max_saves)
+        for job in run:
+            if job.error is None:
+                print "  %s: saved" % (job.uuid,)
+            else:
+                print "  %s: FAILED - %s" % (job.uuid, job.error)
+        print "Saved %dMB in %.1f seconds (%.1fMB/s)" % (run.saved, run.elapsed(), run.throughput())
+        sys.exit(0)
+
     cherrypy.config.update({
         'server.socket_port': port,
+        # Up to max_listeners of these are held by /events clients.
+        'server.thread_pool': thread_pool,
         'cherrypy.server.socket_host': '0.0.0.0',
         'tools.encode.on': True, 'tools.encode.encoding': 'utf-8',
         'tools.decode.on': True,
@@ -126,9 +253,26 @@ def main(argv):
         'tools.staticdir.root': os.path.abspath(os.path.dirname(__file__)),
     })
 
-    root = Root(LocalManager(), vbox)
-    root.vm = VM(LocalManager(), vbox)
-    root.hard_disk = HardDisk(LocalManager(), vbox)
+    templating.configure(production)
+
+    logger = logging.getLogger('vboxweb')
+    logger.addHandler(logging.StreamHandler())
+    logger.setLevel(logging.INFO)
+
+    # Without callbacks the inventory and ETags still expire every max_age seconds.
+    event_loop = events.EventLoop(vbox, bus)
+    poller = None
+    if not event_loop.start() or poll:
+        logger.info("Polling machine states")
+        poller = events.StatePoller(vbox, bus)
+        poller.start()
+
+    catalog = GuestOSCatalog(web_vbox)
+    system_properties = SystemProperties(web_vbox)
+
+    root = Root(web_manager, web_vbox, inventory, catalog, generations, event_stream, event_loop, poller)
+    root.vm = VM(sessions, web_vbox, jobs, BootScheduler(web_vbox, jobs), catalog, system_properties, generations, bus)
+    root.hard_disk = HardDisk(web_manager, web_vbox, system_properties, generations)
 
     cherrypy.quickstart(root, '/', {
         '/': {
@@ -36,8 +36,9 @@
 # ***** END LICENSE BLOCK *****
 
 import os
-import new
 import logging
+import threading
+import weakref
 from xpcom import xpt, COMException, nsError, logger
 
 # Suck in stuff from _xpcom we use regularly to prevent a module lookup
@@ -95,15 +96,42 @@ def _MakeMethodCode(method):
 interface_cache = {}
 # Keyed by [iid][name], each item is an unbound method.
 interface_method_cache = {}
+# Keyed by IID, each item is a dict mapping every method, getter, setter
+# and constant name of the interface to the IID.  Shared by all instances.
+interface_name_cache = {}
+# Keyed by IID, each item is {iid: interface info} - the _interface_infos_
+# of a component that only supports that one interface.
+interface_infos_cache = {}
+# Keyed by IID, each item is the _GeneratedInterface subclass built for it.
+interface_class_cache = {}
+
+# Keyed by the raw object, which hashes and compares by the identity of the
+# underlying XPCOM object, each item is the live Component wrapping it.
+wrapper_cache = weakref.WeakValueDictionary()
+wrapper_cache_hits = 0
+wrapper_cache_misses = 0
 
 # Keyed by clsid from nsIClassInfo - everything ever queried for the CID.
 contractid_info_cache = {}
 have_shutdown = 0
 
+# The caches are read without locking - a dict lookup is atomic, and entries
+# are only ever stored fully built.  Building an entry takes the lock stripe
+# for its IID, so each interface and method is built once while other
+# threads wanting the same IID wait for it.
+_build_locks = [threading.Lock() for i in range(16)]
+
+def _build_lock(iid):
+    return _build_locks[hash(iid) % len(_build_locks)]
+
 def _shutdown():
     interface_cache.clear()
     interface_method_cache.clear()
+    interface_name_cache.clear()
+    interface_infos_cache.clear()
+    interface_class_cache.clear()
     contractid_info_cache.clear()
+    wrapper_cache.clear()
     global have_shutdown
     have_shutdown = 1
 
@@ -114,23 +142,32 @@ def BuildMethod(method_info, iid):
         return interface_method_cache[iid][name]
     except KeyError:
         pass
-    # Generate it.
-    assert not (method_info.IsSetter() or method_info.IsGetter()), "getters and setters should have been weeded out by now"
-    method_code = _MakeMethodCode(method_info)
-    # Build the method - We only build a function object here
-    # - they are bound to each instance as needed.
-    
-##    print "Method Code for %s (%s):" % (name, iid)
-##    print method_code
-    codeObject = compile(method_code, "<XPCOMObject method '%s'>" % (name,), "exec")
-    # Exec the code object
-    tempNameSpace = {}
-    exec codeObject in globals(), tempNameSpace
-    ret = tempNameSpace[name]
-    if not interface_method_cache.has_key(iid):
-        interface_method_cache[iid] = {}
-    interface_method_cache[iid][name] = ret
-    return ret
+    lock = _build_lock(iid)
+    lock.acquire()
+    try:
+        # Another thread may have built it while we waited.
+        methods = interface_method_cache.get(iid)
+        if methods is not None and methods.has_key(name):
+            return methods[name]
+        # Generate it.
+        assert not (method_info.IsSetter() or method_info.IsGetter()), "getters and setters should have been weeded out by now"
+        method_code = _MakeMethodCode(method_info)
+        # Build the method - We only build a function object here
+        # - they are bound to each instance as needed.
+
+##        print "Method Code for %s (%s):" % (name, iid)
+##        print method_code
+        codeObject = compile(method_code, "<XPCOMObject method '%s'>" % (name,), "exec")
+        # Exec the code object
+        tempNameSpace = {}
+        exec codeObject in globals(), tempNameSpace
+        ret = tempNameSpace[name]
+        if methods is None:
+            methods = interface_method_cache[iid] = {}
+        methods[name] = ret
+        return ret
+    finally:
+        lock.release()
 
 from xpcom.xpcom_consts import XPT_MD_GETTER, XPT_MD_SETTER, XPT_MD_NOTXPCOM, XPT_MD_CTOR, XPT_MD_HIDDEN
 FLAGS_TO_IGNORE = XPT_MD_NOTXPCOM | XPT_MD_CTOR | XPT_MD_HIDDEN
@@ -140,35 +177,82 @@ FLAGS_TO_IGNORE = XPT_MD_NOTXPCOM | XPT_MD_CTOR | XPT_MD_HIDDEN
 def BuildInterfaceInfo(iid):
     assert not have_shutdown, "Can't build interface info after a shutdown"
     ret = interface_cache.get(iid, None)
-    if ret is None:
-        # Build the data for the cache.
-        method_code_blocks = []
-        getters = {}
-        setters = {}
-        method_infos = {}
-        
-        interface = xpt.Interface(iid)
-        for m in interface.methods:
-            flags = m.flags
-            if flags & FLAGS_TO_IGNORE == 0:
-                if flags & XPT_MD_SETTER:
-                    param_flags = map(lambda x: (x.param_flags,) + xpt.MakeReprForInvoke(x), m.params)
-                    setters[m.name] = m.method_index, param_flags
-                elif flags & XPT_MD_GETTER:
-                    param_flags = map(lambda x: (x.param_flags,) + xpt.MakeReprForInvoke(x), m.params)
-                    getters[m.name] = m.method_index, param_flags
-                else:
-                    method_infos[m.name] = m
+    if ret is not None:
+        return ret
+    lock = _build_lock(iid)
+    lock.acquire()
+    try:
+        ret = interface_cache.get(iid, None)
+        if ret is None:
+            ret = _BuildInterfaceInfo(iid)
+            _CacheInterfaceInfo(iid, ret)
+        return ret
+    finally:
+        lock.release()
+
+def _CacheInterfaceInfo(iid, info):
+    names = {}
+    for d in info:
+        for name in d.keys():
+            names[name] = iid
+    interface_name_cache[iid] = names
+    interface_cache[iid] = info
+
+# Register an interface built ahead of time, with the functions for all its
+# methods, so it never needs to be built here.  Returns false if the
+# interface has already been built.
+def RegisterInterfaceInfo(iid, info, methods):
+    lock = _build_lock(iid)
+    lock.acquire()
+    try:
+        if interface_cache.has_key(iid):
+            return 0
+        interface_method_cache[iid] = methods.copy()
+        _CacheInterfaceInfo(iid, info)
+        return 1
+    finally:
+        lock.release()
+
+def _BuildInterfaceInfo(iid):
+    # Build the data for the cache.
+    getters = {}
+    setters = {}
+    method_infos = {}
+
+    interface = xpt.Interface(iid)
+    for m in interface.methods:
+        flags = m.flags
+        if flags & FLAGS_TO_IGNORE == 0:
+            if flags & XPT_MD_SETTER:
+                param_flags = map(lambda x: (x.param_flags,) + xpt.MakeReprForInvoke(x), m.params)
+                setters[m.name] = m.method_index, param_flags
+            elif flags & XPT_MD_GETTER:
+                param_flags = map(lambda x: (x.param_flags,) + xpt.MakeReprForInvoke(x), m.params)
+                getters[m.name] = m.method_index, param_flags
+            else:
+                method_infos[m.name] = m
+
+    # Build the constants.
+    constants = {}
+    for c in interface.constants:
+        constants[c.name] = c.value
+    return method_infos, getters, setters, constants
 
-        # Build the constants.
-        constants = {}
-        for c in interface.constants:
-            constants[c.name] = c.value
-        ret = method_infos, getters, setters, constants
-        interface_cache[iid] = ret
-    return ret
+# The shared, empty starting point for per-instance interface tables.
+_no_interfaces = {}
+
+# The wrappers use __slots__ and override __setattr__, so they set their own
+# attributes with this.
+_set = object.__setattr__
+
+# MakeInterfaceResult hands the same Component to every thread, so changes
+# to a component's interface tables are made under this lock.  They are
+# rare - the first use of each interface - and reads never take it.
+_wrapper_lock = threading.RLock()
+
+class _XPCOMBase(object):
+    __slots__ = ()
 
-class _XPCOMBase:
     def __cmp__(self, other):
         try:
             other = other._comobj_
@@ -231,6 +315,10 @@ class _XPCOMBase:
         return self._do_conversion(_float_interfaces, float)
     
 class Component(_XPCOMBase):
+    __slots__ = ('_comobj_', '_interfaces_', '_interface_names_', '_interface_infos_',
+                 '_name_to_interface_iid_', '_tried_classinfo_', '_object_name_',
+                 '_com_classinfo_', '__weakref__')
+
     def __init__(self, ob, iid = IID_nsISupports):
         assert not hasattr(ob, "_comobj_"), "Should be a raw nsIWhatever, not a wrapped one"
         ob_name = None
@@ -240,39 +328,42 @@ class Component(_XPCOMBase):
             ob = cm.createInstanceByContractID(ob)
             assert not hasattr(ob, "_comobj_"), "The created object should be a raw nsIWhatever, not a wrapped one"
         # Keep a reference to the object in the component too
-        self.__dict__['_comobj_'] = ob
-        # hit __dict__ directly to avoid __setattr__()
-        self.__dict__['_interfaces_'] = {} # keyed by IID
-        self.__dict__['_interface_names_'] = {} # keyed by IID name
-        self.__dict__['_interface_infos_'] = {} # keyed by IID
-        self.__dict__['_name_to_interface_iid_'] = {}
-        self.__dict__['_tried_classinfo_'] = 0
+        _set(self, '_comobj_', ob)
+        # Go through _set to avoid __setattr__()
+        # All four tables start out as the shared empty dict.  The first two
+        # get a dict of their own on the first QueryInterface().
+        _set(self, '_interfaces_', _no_interfaces) # keyed by IID
+        _set(self, '_interface_names_', _no_interfaces) # keyed by IID name
+        # These two may be shared with other instances, so they are never
+        # modified - _remember_interface_info() and friends replace them.
+        _set(self, '_interface_infos_', _no_interfaces) # keyed by IID
+        _set(self, '_name_to_interface_iid_', _no_interfaces)
+        _set(self, '_tried_classinfo_', 0)
 
         if ob_name is None:
             ob_name = "<unknown>"
-        self.__dict__['_object_name_'] = ob_name
+        _set(self, '_object_name_', ob_name)
         self.QueryInterface(iid)
 
     def _build_all_supported_interfaces_(self):
         # Use nsIClassInfo, but don't do it at object construction to keep perf up.
         # Only pay the penalty when we really need it.
-        assert not self._tried_classinfo_, "already tried to get the class info."
-        self.__dict__['_tried_classinfo_'] = 1
+        # The XPCOM calls are made without holding _wrapper_lock.  Two threads
+        # may both make them; the tables end up the same either way.
         # See if nsIClassInfo is supported.
         try:
             classinfo = self._comobj_.QueryInterface(IID_nsIClassInfo, 0)
         except COMException:
             classinfo = None
+        real_cid = None
+        contractid_info = None
         if classinfo is not None:
             try:
                 real_cid = classinfo.contractID
             except COMException:
                 real_cid = None
             if real_cid:
-                self.__dict__['_object_name_'] = real_cid
                 contractid_info = contractid_info_cache.get(real_cid)
-            else:
-                contractid_info = None
             if contractid_info is None:
                 try:
                     interface_infos = classinfo.getInterfaces()
@@ -280,43 +371,73 @@ class Component(_XPCOMBase):
                     interface_infos = []
                 for nominated_iid in interface_infos:
                     # Interface may appear twice in the class info list, so check this here.
-                    if not self.__dict__['_interface_infos_'].has_key(nominated_iid):
+                    if not self._interface_infos_.has_key(nominated_iid):
                         # Just invoke our QI on the object
                         self.queryInterface(nominated_iid)
                 if real_cid is not None:
-                    contractid_info = {}
-                    contractid_info['_name_to_interface_iid_'] = self.__dict__['_name_to_interface_iid_']
-                    contractid_info['_interface_infos_'] = self.__dict__['_interface_infos_']
-                    contractid_info_cache[real_cid] = contractid_info
-            else:
-                for key, val in contractid_info.items():
-                    self.__dict__[key].update(val)
+                    new_info = {}
+                    new_info['_name_to_interface_iid_'] = self._name_to_interface_iid_
+                    new_info['_interface_infos_'] = self._interface_infos_
+                    contractid_info_cache[real_cid] = new_info
 
-        self.__dict__['_com_classinfo_'] = classinfo
+        _wrapper_lock.acquire()
+        try:
+            if real_cid:
+                _set(self, '_object_name_', real_cid)
+            for key, val in (contractid_info or {}).items():
+                mine = getattr(self, key)
+                for name in mine.keys():
+                    if not val.has_key(name):
+                        merged = mine.copy()
+                        merged.update(val)
+                        _set(self, key, merged)
+                        break
+                else:
+                    # Nothing the cached info doesn't already have.
+                    _set(self, key, val)
+            _set(self, '_com_classinfo_', classinfo)
+            # Last, so that a thread which sees it set also sees the tables.
+            _set(self, '_tried_classinfo_', 1)
+        finally:
+            _wrapper_lock.release()
 
     def _remember_interface_info(self, iid):
-        # XXX - there is no good reason to cache this only in each instance
-        # It should be cached at the module level, so we don't need to
-        # rebuild the world for each new object.
-        iis = self.__dict__['_interface_infos_']
-        assert not iis.has_key(iid), "Already remembered this interface!"
         try:
-            method_infos, getters, setters, constants = BuildInterfaceInfo(iid)
+            info = BuildInterfaceInfo(iid)
         except COMException, why:
             # Failing to build an interface info generally isn't a real
             # problem - its probably just that the interface is non-scriptable.
             logger.info("Failed to build interface info for %s: %s", iid, why)
             # Remember the fact we failed.
-            iis[iid] = None
-            return
-
-        # Remember all the names so we can delegate
-        iis[iid] = method_infos, getters, setters, constants
-        names = self.__dict__['_name_to_interface_iid_']
-        for name in method_infos.keys(): names[name] = iid
-        for name in getters.keys(): names[name] = iid
-        for name in setters.keys(): names[name] = iid
-        for name in constants.keys():  names[name] = iid
+            info = None
+        _wrapper_lock.acquire()
+        try:
+            iis = self._interface_infos_
+            if iis.has_key(iid):
+                # Another thread remembered it first.
+                return
+            if info is None:
+                iis = iis.copy()
+                iis[iid] = None
+                _set(self, '_interface_infos_', iis)
+                return
+            # Remember all the names so we can delegate.  The common case of a
+            # single interface shares the module level tables outright.
+            names = self._name_to_interface_iid_
+            if iis:
+                iis = iis.copy()
+                iis[iid] = info
+                names = names.copy()
+                names.update(interface_name_cache[iid])
+            else:
+                iis = interface_infos_cache.get(iid)
+                if iis is None:
+                    iis = interface_infos_cache[iid] = {iid: info}
+                names = interface_name_cache[iid]
+            _set(self, '_interface_infos_', iis)
+            _set(self, '_name_to_interface_iid_', names)
+        finally:
+            _wrapper_lock.release()
 
     def QueryInterface(self, iid):
         if self._interfaces_.has_key(iid):
@@ -336,10 +457,18 @@ class Component(_XPCOMBase):
         raw_iface = self._comobj_.QueryInterface(iid, 0)
 
         method_infos, getters, setters, constants = iface_info
-        new_interface = _Interface(raw_iface, iid, method_infos,
-                                   getters, setters, constants)
-        self._interfaces_[iid] = new_interface
-        self._interface_names_[iid.name] = new_interface
+        new_interface = BuildInterfaceClass(iid)(raw_iface, iid, method_infos,
+                                                 getters, setters, constants)
+        _wrapper_lock.acquire()
+        try:
+            if self._interfaces_ is _no_interfaces:
+                _set(self, '_interfaces_', {iid: new_interface})
+                _set(self, '_interface_names_', {iid.name: new_interface})
+            elif not self._interfaces_.has_key(iid):
+                self._interfaces_[iid] = new_interface
+                self._interface_names_[iid.name] = new_interface
+        finally:
+            _wrapper_lock.release()
         # As we 'flatten' objects when possible, a QI on an object just
         # returns ourself - all the methods etc on this interface are
         # available.
@@ -347,37 +476,63 @@ class Component(_XPCOMBase):
 
     queryInterface = QueryInterface # Alternate name.
 
+    def get_many(self, names):
+        """Read several properties at once, returning their values as a tuple
+        in the same order as names.
+
+        Each getter is invoked directly with its precomputed arguments, so
+        this is much cheaper than reading the attributes one by one.  Names
+        that are not plain getters are read with getattr()."""
+        name_to_iid = self._name_to_interface_iid_
+        interfaces = self._interfaces_
+        ret = []
+        for name in names:
+            interface = interfaces.get(name_to_iid.get(name, None), None)
+            if interface is not None:
+                info = interface._getter_args_.get(name, None)
+                if info is not None:
+                    ret.append(XPTC_InvokeByIndex(interface._comobj_, info[0], info[1]))
+                    continue
+            ret.append(getattr(self, name))
+        return tuple(ret)
+
     def __getattr__(self, attr):
         if attr in _special_getattr_names:
             raise AttributeError, attr
         # First allow the interface name to return the "raw" interface
-        interface = self.__dict__['_interface_names_'].get(attr, None)
+        interface = self._interface_names_.get(attr, None)
         if interface is not None:
             return interface
         # See if we know the IID of an interface providing this attribute
-        iid = self.__dict__['_name_to_interface_iid_'].get(attr, None)
+        iid = self._name_to_interface_iid_.get(attr, None)
         # This may be first time trying this interface - get the nsIClassInfo
         if iid is None and not self._tried_classinfo_:
             self._build_all_supported_interfaces_()
-            iid = self.__dict__['_name_to_interface_iid_'].get(attr, None)
+            iid = self._name_to_interface_iid_.get(attr, None)
             # If the request is for an interface name, it may now be
             # available.
-            interface = self.__dict__['_interface_names_'].get(attr, None)
+            interface = self._interface_names_.get(attr, None)
             if interface is not None:
                 return interface
 
         if iid is not None:
-            interface = self.__dict__['_interfaces_'].get(iid, None)
+            interface = self._interfaces_.get(iid, None)
             if interface is None:
                 self.QueryInterface(iid)
-                interface = self.__dict__['_interfaces_'][iid]
+                interface = self._interfaces_[iid]
             return getattr(interface, attr)
         # Some interfaces may provide this name via "native" support.
         # Loop over all interfaces, and if found, cache it for next time.
-        for interface in self.__dict__['_interfaces_'].values():
+        for interface in self._interfaces_.values():
             try:
                 ret = getattr(interface, attr)
-                self.__dict__['_name_to_interface_iid_'][attr] = interface._iid_
+                _wrapper_lock.acquire()
+                try:
+                    names = self._name_to_interface_iid_.copy()
+                    names[attr] = interface._iid_
+                    _set(self, '_name_to_interface_iid_', names)
+                finally:
+                    _wrapper_lock.release()
                 return ret
             except AttributeError:
                 pass
@@ -388,12 +543,12 @@ class Component(_XPCOMBase):
         # This may be first time trying this interface - get the nsIClassInfo
         if iid is None and not self._tried_classinfo_:
             self._build_all_supported_interfaces_()
-            iid = self.__dict__['_name_to_interface_iid_'].get(attr, None)
+            iid = self._name_to_interface_iid_.get(attr, None)
         if iid is not None:
             interface = self._interfaces_.get(iid, None)
             if interface is None:
                 self.QueryInterface(iid)
-                interface = self.__dict__['_interfaces_'][iid]
+                interface = self._interfaces_[iid]
             setattr(interface, attr, val)
             return
         raise AttributeError, "XPCOM component '%s' has no attribute '%s'" % (self._object_name_, attr)
@@ -407,9 +562,9 @@ class Component(_XPCOMBase):
             # Error building the info - ignore the error, but ensure that
             # we are flagged as *not* having built, so the error is seen
             # by the first caller who actually *needs* this to work.
-            self.__dict__['_tried_classinfo_'] = 0
+            _set(self, '_tried_classinfo_', 0)
 
-        iface_names = self.__dict__['_interface_names_'].keys()
+        iface_names = self._interface_names_.keys()
         try:
             iface_names.remove("nsISupports")
         except ValueError:
@@ -424,77 +579,119 @@ class Component(_XPCOMBase):
         iface_desc = self._get_classinfo_repr_()
         return "<XPCOM component '%s' (%s)>" % (self._object_name_,iface_desc)
 
-class _Interface(_XPCOMBase):
+def _MakeGetter(method_index, param_infos):
+    if len(param_infos)!=1: # Only expecting a retval
+        def getter(self):
+            raise RuntimeError, "Can't get properties with this many args!"
+        return getter
+    args = ( param_infos, () )
+    def getter(self):
+        return XPTC_InvokeByIndex(self._comobj_, method_index, args)
+    return getter
+
+def _MakeSetter(method_index, param_infos):
+    if len(param_infos)!=1: # Only expecting a single input val
+        def setter(self, val):
+            raise RuntimeError, "Can't set properties with this many args!"
+        return setter
+    def setter(self, val):
+        XPTC_InvokeByIndex(self._comobj_, method_index, ( param_infos, (val,) ))
+    return setter
+
+class _GeneratedInterface(_XPCOMBase):
+    # The base of the classes built by BuildInterfaceClass().  Getters and
+    # setters are properties, constants are class attributes and methods
+    # are added to the class the first time any instance uses them, so
+    # most lookups never reach __getattr__.  Everything but the object
+    # itself lives on the class, so an instance is a single slot.
+    __slots__ = ('_comobj_',)
+    _setter_names_ = {}
+    # Keyed by getter name, the method index and XPTC_InvokeByIndex args.
+    _getter_args_ = {}
+
     def __init__(self, comobj, iid, method_infos, getters, setters, constants):
-        self.__dict__['_comobj_'] = comobj
-        self.__dict__['_iid_'] = iid
-        self.__dict__['_property_getters_'] = getters
-        self.__dict__['_property_setters_'] = setters
-        self.__dict__['_method_infos_'] = method_infos # method infos waiting to be turned into real methods.
-        self.__dict__['_methods_'] = {} # unbound methods
-        self.__dict__['_object_name_'] = iid.name
-        self.__dict__.update(constants)
-        # We remember the constant names to prevent the user trying to assign to them!
-        self.__dict__['_constant_names_'] = constants.keys()
+        _set(self, '_comobj_', comobj)
 
     def __getattr__(self, attr):
-        # Allow the underlying interface to provide a better implementation if desired.
         if attr in _special_getattr_names:
             raise AttributeError, attr
-
-        ret = getattr(self.__dict__['_comobj_'], attr, None)
+        # Allow the underlying interface to provide a better implementation if desired.
+        ret = getattr(self._comobj_, attr, None)
         if ret is not None:
             return ret
-        # Do the function thing first.
-        unbound_method = self.__dict__['_methods_'].get(attr, None)
-        if unbound_method is not None:
-            return new.instancemethod(unbound_method, self, self.__class__)
-
-        getters = self.__dict__['_property_getters_']
-        info = getters.get(attr)
-        if info is not None:
-            method_index, param_infos = info
-            if len(param_infos)!=1: # Only expecting a retval
-                raise RuntimeError, "Can't get properties with this many args!"
-            args = ( param_infos, () )
-            return XPTC_InvokeByIndex(self._comobj_, method_index, args)
-
-        # See if we have a method info waiting to be turned into a method.
-        # Do this last as it is a one-off hit.
-        method_info = self.__dict__['_method_infos_'].get(attr, None)
+        cls = self.__class__
+        method_info = cls._method_infos_.get(attr, None)
         if method_info is not None:
-            unbound_method = BuildMethod(method_info, self._iid_)
-            # Cache it locally
-            self.__dict__['_methods_'][attr] = unbound_method
-            return new.instancemethod(unbound_method, self, self.__class__)
-
+            setattr(cls, attr, BuildMethod(method_info, cls._iid_))
+            return getattr(self, attr)
         raise AttributeError, "XPCOM component '%s' has no attribute '%s'" % (self._object_name_, attr)
 
     def __setattr__(self, attr, val):
-        # If we already have a __dict__ item of that name, and its not one of
-        # our constants, we just directly set it, and leave.
-        if self.__dict__.has_key(attr) and attr not in self.__dict__['_constant_names_']:
-            self.__dict__[attr] = val
-            return
-        # Start sniffing for what sort of attribute this might be?
-        setters = self.__dict__['_property_setters_']
-        info = setters.get(attr)
-        if info is None:
+        if not self._setter_names_.has_key(attr):
             raise AttributeError, "XPCOM component '%s' can not set attribute '%s'" % (self._object_name_, attr)
-        method_index, param_infos = info
-        if len(param_infos)!=1: # Only expecting a single input val
-            raise RuntimeError, "Can't set properties with this many args!"
-        real_param_infos = ( param_infos, (val,) )
-        return XPTC_InvokeByIndex(self._comobj_, method_index, real_param_infos)
+        _set(self, attr, val)
 
     def __repr__(self):
         return "<XPCOM interface '%s'>" % (self._object_name_,)
 
+def BuildInterfaceClass(iid):
+    cls = interface_class_cache.get(iid, None)
+    if cls is not None:
+        return cls
+    method_infos, getters, setters, constants = BuildInterfaceInfo(iid)
+    lock = _build_lock(iid)
+    lock.acquire()
+    try:
+        cls = interface_class_cache.get(iid, None)
+        if cls is None:
+            namespace = constants.copy()
+            namespace.update(interface_method_cache.get(iid, {}))
+            getter_args = {}
+            for name, (method_index, param_infos) in getters.items():
+                namespace[name] = property(_MakeGetter(method_index, param_infos))
+                if len(param_infos)==1:
+                    getter_args[name] = method_index, ( param_infos, () )
+            for name, (method_index, param_infos) in setters.items():
+                fget = None
+                if namespace.has_key(name):
+                    fget = namespace[name].fget
+                namespace[name] = property(fget, _MakeSetter(method_index, param_infos))
+            namespace['__slots__'] = ()
+            namespace['_iid_'] = iid
+            namespace['_object_name_'] = iid.name
+            namespace['_method_infos_'] = method_infos
+            namespace['_property_getters_'] = getters
+            namespace['_property_setters_'] = setters
+            namespace['_setter_names_'] = setters
+            namespace['_getter_args_'] = getter_args
+            namespace['_constant_names_'] = constants.keys()
+            cls = type("_Interface_%s" % (iid.name,), (_GeneratedInterface,), namespace)
+            interface_class_cache[iid] = cls
+        return cls
+    finally:
+        lock.release()
 
 # Called by the _xpcom C++ framework to wrap interfaces up just
 # before they are returned.
+# The same XPCOM object always comes back as the same wrapper while that
+# wrapper is alive, so its interface setup is only done once.
 def MakeInterfaceResult(ob, iid):
-    return Component(ob, iid)
+    global wrapper_cache_hits, wrapper_cache_misses
+    try:
+        wrapper = wrapper_cache[ob]
+    except KeyError:
+        wrapper_cache_misses += 1
+        wrapper = wrapper_cache[ob] = Component(ob, iid)
+        return wrapper
+    wrapper_cache_hits += 1
+    # Only to add iid to the wrapper's tables; the shared wrapper is the
+    # result even when QueryInterface has to fall back to a raw object.
+    wrapper.QueryInterface(iid)
+    return wrapper
+
+def WrapperCacheStats():
+    return {'live': len(wrapper_cache), 'hits': wrapper_cache_hits,
+            'misses': wrapper_cache_misses}
 
 class WeakReference:
     """A weak-reference object.  You construct a weak reference by passing